@@ -0,0 +1,267 @@
+# accumulator.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Multi-resolution photon accumulation. Level k is a (H * 2^k, W * 2^k)
+# histogram of summed photon P over the detector, so a zoom of 2^k is a
+# screen-sized slice of level k: rendering any zoom/pan costs O(screen).
+###############################################################################
+
+import numpy as np
+
+# uint32 planes would wrap a hot pixel to black after ~2^32/P photons. They
+# are clamped to PIXEL_MAX whenever the P added since the last clamp could
+# reach the top, so the check costs one pass per ~2^31 of P, not per photon.
+PIXEL_MAX = 2 ** 31
+PIXEL_HEADROOM = 2 ** 32 - 1 - PIXEL_MAX
+
+class PhotonPyramid():
+    def __init__(self, width, height, src_size_bit_depth=14, num_levels=1):
+        # Past the detector's own resolution a level adds nothing
+        max_levels = 1
+        while (width << max_levels) <= 2 ** src_size_bit_depth:
+            max_levels += 1
+        self.num_levels = max(1, min(num_levels, max_levels))
+        self.active_levels = self.num_levels  # levels fed by accumulate()
+
+        self.width = width
+        self.height = height
+        self.levels = []
+        self.scales = []
+        self.unclamped = [0] * self.num_levels  # P added since the last clamp
+        for k in range(self.num_levels):
+            self.levels.append(np.zeros((height << k, width << k), dtype=np.uint32))
+            self.scales.append(((width << k) - 1) / (2 ** src_size_bit_depth - 1))
+
+    def accumulate(self, xs, ys, ps):
+        # Adds a batch to every level, returns the (x, y, p) photons kept on
+        # each level (off-detector photons dropped) for dirty tracking
+        hits = []
+        ps = ps.astype(np.uint32)
+        for k in range(self.active_levels):
+            plane = self.levels[k]
+            scale = self.scales[k]
+            x = (xs * scale + 0.5).astype(np.intp)
+            y = (ys * scale + 0.5).astype(np.intp)
+            p = ps
+
+            valid = (x < plane.shape[1]) & (y < plane.shape[0])
+            if not valid.all():
+                x = x[valid]
+                y = y[valid]
+                p = ps[valid]
+
+            hits.append(self.add_pixels(k, x, y, p))
+
+        return hits
+
+    def add_pixels(self, level, x, y, p):
+        # Photons already placed on the plane (in bounds), returns the hits
+        self.add_flat(level, y * self.levels[level].shape[1] + x, p)
+        return x, y, p
+
+    def add_flat(self, level, idx, p):
+        p_sum = int(p.sum())
+        if self.unclamped[level] + p_sum > PIXEL_HEADROOM:
+            np.minimum(self.levels[level], PIXEL_MAX, out=self.levels[level])
+            self.unclamped[level] = 0
+        self.unclamped[level] += p_sum
+        np.add.at(self.levels[level].reshape(-1), idx, p)
+
+    def window(self, level, cx, cy):
+        # Top-left of the screen-sized window on `level` centred on (cx, cy),
+        # given as fractions of the detector, clamped to the plane
+        plane = self.levels[level]
+        x0 = int(round(cx * plane.shape[1] - self.width / 2))
+        y0 = int(round(cy * plane.shape[0] - self.height / 2))
+        x0 = min(max(x0, 0), plane.shape[1] - self.width)
+        y0 = min(max(y0, 0), plane.shape[0] - self.height)
+        return x0, y0
+
+    def view(self, level, x0, y0):
+        return self.levels[level][y0:y0+self.height, x0:x0+self.width]
+
+    def clear(self):
+        for plane in self.levels:
+            plane[:] = 0
+
+class SourceTiles():
+    # Split screen: each shown source gets a square tile of the screen in a
+    # near-square grid, and its photons are scaled into that tile. place()
+    # offsets each photon by its source's tile origin (one gather per batch)
+    # into the one screen-sized plane, so there is nothing to compose at blit
+    # time. Sources are indexes into tdc_dict (the pad byte).
+    def __init__(self, width, height, sources, src_size_bit_depth=14):
+        self.sources = list(sources)
+        cols = int(np.ceil(np.sqrt(len(self.sources))))
+        rows = int(np.ceil(len(self.sources) / cols))
+        cell_w = width // cols
+        cell_h = height // rows
+        self.side = min(cell_w, cell_h)
+        self.scale = (self.side - 1) / (2 ** src_size_bit_depth - 1)
+
+        # Per source index lookups, so placing a batch is one gather
+        self.shown = np.zeros(256, dtype=bool)
+        self.x0 = np.zeros(256, dtype=np.intp)
+        self.y0 = np.zeros(256, dtype=np.intp)
+        self.tiles = []  # (source, x0, y0) of each tile's top-left corner
+        for i, src in enumerate(self.sources):
+            x0 = (i % cols) * cell_w + (cell_w - self.side) // 2
+            y0 = (i // cols) * cell_h + (cell_h - self.side) // 2
+            self.shown[src] = True
+            self.x0[src] = x0
+            self.y0[src] = y0
+            self.tiles.append((src, x0, y0))
+
+    def place(self, xs, ys, ps, srcs):
+        # Screen pixel of every photon from a shown source, the rest dropped
+        shown = self.shown[srcs]
+        if not shown.all():
+            xs = xs[shown]
+            ys = ys[shown]
+            ps = ps[shown]
+            srcs = srcs[shown]
+
+        x = (xs * self.scale + 0.5).astype(np.intp)
+        y = (ys * self.scale + 0.5).astype(np.intp)
+        valid = (x < self.side) & (y < self.side)
+        if not valid.all():
+            x = x[valid]
+            y = y[valid]
+            ps = ps[valid]
+            srcs = srcs[valid]
+
+        return x + self.x0[srcs], y + self.y0[srcs], ps
+
+# Sender-side pre-binned batch: summed raw P and photon count per screen
+# (level 0) pixel, idx = y * width + x
+DELTA_DTYPE = np.dtype([('idx', '<u4'), ('p', '<u4'), ('n', '<u4')])
+
+class PhotonBinner():
+    # Collapses a batch of photons into sparse level-0 pixel deltas, with the
+    # same scaling and rounding as PhotonPyramid level 0 (or SourceTiles)
+    def __init__(self, width, height, src_size_bit_depth=14, tiles=None):
+        self.width = width
+        self.height = height
+        self.scale = (width - 1) / (2 ** src_size_bit_depth - 1)
+        self.tiles = tiles
+
+    def bin(self, photons):
+        if self.tiles is not None:
+            x, y, p = self.tiles.place(photons['x'], photons['y'], photons['p'], photons['pad'])
+        else:
+            x = (photons['x'] * self.scale + 0.5).astype(np.intp)
+            y = (photons['y'] * self.scale + 0.5).astype(np.intp)
+            p = photons['p']
+
+            valid = (x < self.width) & (y < self.height)
+            if not valid.all():
+                x = x[valid]
+                y = y[valid]
+                p = p[valid]
+
+        idx, inverse = np.unique(y * self.width + x, return_inverse=True)
+        delta = np.empty(len(idx), dtype=DELTA_DTYPE)
+        delta['idx'] = idx
+        delta['p'] = np.bincount(inverse, weights=p, minlength=len(idx))
+        delta['n'] = np.bincount(inverse, minlength=len(idx))
+        return delta
+
+# Exposure modes for the pyramid: keep everything, only the last N steps,
+# or fade older photons out
+EXPOSURES = ('infinite', 'rolling', 'decay')
+MAX_ROLLING_BYTES = 128 * 2**20  # rolling ring larger than this is refused
+
+class RollingExposure():
+    # Ring of num_steps completed level-0 sub-frames plus their running sum.
+    # Photons still land in the pyramid (the current sub-frame), so the
+    # per-photon cost is unchanged; shown = window + current. Zoom levels
+    # would multiply the ring by ~4^levels, so rolling runs on level 0 only
+    # (the Framebuffer stops feeding and showing the others). Sub-frames are
+    # clamped like any plane, but the running sum is not: it wraps if one
+    # pixel gets over 2^32 of P inside the window.
+    def __init__(self, pyramid, num_steps):
+        self.pyramid = pyramid
+        plane = pyramid.levels[0]
+        self.ring = [np.zeros(plane.shape, dtype=plane.dtype) for i in range(num_steps)]
+        self.window = [np.zeros(plane.shape, dtype=plane.dtype)]
+        self.idx = 0
+
+    @staticmethod
+    def ring_bytes(pyramid, num_steps):
+        # What __init__ would allocate, to check before allocating
+        return pyramid.levels[0].nbytes * (num_steps + 1)
+
+    @property
+    def nbytes(self):
+        return self.window[0].nbytes * (len(self.ring) + 1)
+
+    def step(self):
+        # O(screen pixels): retire the oldest sub-frame, bank the current one
+        cur = self.pyramid.levels[0]
+        old = self.ring[self.idx]
+        win = self.window[0]
+        np.subtract(win, old, out=win)
+        np.add(win, cur, out=win)
+        old[:] = cur
+        cur[:] = 0
+        self.idx = (self.idx + 1) % len(self.ring)
+
+    def window_view(self, level, x0, y0):
+        return self.window[level][y0:y0+self.pyramid.height, x0:x0+self.pyramid.width]
+
+    def fold(self):
+        # Leaving rolling mode: the window becomes plain accumulated data
+        self.pyramid.levels[0] += self.window[0]
+
+    def clear(self):
+        for plane in self.window + self.ring:
+            plane[:] = 0
+
+DECAY_FRAC_SCALE = 256  # fraction plane resolution (uint8)
+
+class DecayExposure():
+    # Exponential decay: every step the whole pyramid is scaled in place.
+    # The integer planes can't hold the fractions, so a uint8 plane per level
+    # carries them between steps; truncating instead would wipe out faint
+    # pixels long before one time constant. Photons still only touch the
+    # integer planes.
+    def __init__(self, pyramid, factor):
+        self.pyramid = pyramid
+        self.factor = factor
+        self.frac = [np.zeros(p.shape, dtype=np.uint8) for p in pyramid.levels]
+        # Levels are scaled a level-0 sized block of rows at a time
+        self.scratch = np.empty(pyramid.levels[0].size, dtype=np.float64)
+
+    @property
+    def nbytes(self):
+        return sum(f.nbytes for f in self.frac) + self.scratch.nbytes
+
+    def step(self):
+        for plane, frac in zip(self.pyramid.levels, self.frac):
+            rows = len(self.scratch) // plane.shape[1]
+            for r in range(0, plane.shape[0], rows):
+                p = plane[r:r+rows]
+                f = frac[r:r+rows]
+                s = self.scratch[:p.size].reshape(p.shape)
+
+                # (integer + fraction) * factor, split back into the two
+                np.multiply(f, 1 / DECAY_FRAC_SCALE, out=s)
+                s += p
+                s *= self.factor
+                np.copyto(p, s, casting='unsafe')
+                s -= p
+                s *= DECAY_FRAC_SCALE
+                np.rint(s, out=s)
+                np.minimum(s, DECAY_FRAC_SCALE - 1, out=s)
+                np.copyto(f, s, casting='unsafe')
+
+    def window_view(self, level, x0, y0):
+        return None
+
+    def fold(self):
+        pass
+
+    def clear(self):
+        for frac in self.frac:
+            frac[:] = 0
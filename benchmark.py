@@ -0,0 +1,277 @@
+# benchmark.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# End-to-end throughput benchmark: synthetic TDC packets over loopback ->
+# AsyncUDPServer (sender process) -> queue/ring -> Plot2FrameBuffer
+# (receiver process) on an offscreen display. Prints JSON results.
+###############################################################################
+
+import sys
+import time
+import json
+import queue
+import socket
+import asyncio
+import logging
+import argparse
+import shlex
+import resource
+import numpy as np
+
+from multiprocessing import Process, Queue, Event
+
+import main as zodplot
+from udp_server import AsyncUDPServer, PHOTON_DTYPE
+from accumulator import PhotonBinner, DELTA_DTYPE
+from display_backend import get_geometry
+from data_rcvr import Plot2FrameBuffer
+from photon_ring import PhotonRing
+from tdc_sim import TDCPacketGenerator, send_packets, DISTRIBUTIONS
+
+LOGGER_NAME = 'zod_bench'
+BENCH_IP = '127.0.0.1'
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class BenchPlot2FrameBuffer(Plot2FrameBuffer):
+    # Plot2FrameBuffer with per-stage timing and queue latency samples
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency_samples = []
+        self.latency_weights = []
+        self.accumulate_busy = 0.0
+        self.render_busy = 0.0
+        self.num_frames = 0
+
+        update_fb = self.fb.update_fb
+        def timed_update_fb():
+            t0 = time.perf_counter()
+            update_fb()
+            self.render_busy += time.perf_counter() - t0
+            self.num_frames += 1
+        self.fb.update_fb = timed_update_fb
+
+    def process_batches(self, batches):
+        t0 = time.perf_counter()
+        super().process_batches(batches)
+        self.accumulate_busy += time.perf_counter() - t0
+
+        now = time.time()
+        for rcv_time, photons in batches:
+            rcv_times, num_photons = self.batch_marks(rcv_time, photons)
+            self.latency_samples.extend(now - t for t in rcv_times)
+            self.latency_weights.extend(num_photons)
+
+    def results(self):
+        lat = np.array(self.latency_samples) * 1000
+        weights = np.array(self.latency_weights)
+        result = {
+            'photons_accumulated': self.fb.num_photons_total,
+            'frames': self.num_frames,
+            'accumulate_busy_s': self.accumulate_busy,
+            'render_busy_s': self.render_busy,
+            'render_ms_per_frame': 1000 * self.render_busy / max(self.num_frames, 1),
+            'display': self.frame_stats.snapshot(),
+        }
+        if len(lat) > 0:
+            # Photon-weighted percentiles of rcv_time -> accumulated
+            order = np.argsort(lat)
+            cdf = np.cumsum(weights[order]) / weights.sum()
+            for pct in LATENCY_PERCENTILES:
+                idx = min(np.searchsorted(cdf, pct / 100), len(lat) - 1)
+                result[f'latency_p{pct}_ms'] = float(lat[order][idx])
+            result['latency_max_ms'] = float(lat.max())
+
+        return result
+
+def start_bench_receiver(q_mp, closing_event, opts, result_q):
+    logger = logging.getLogger(LOGGER_NAME)
+
+    async def run():
+        plot2FB = BenchPlot2FrameBuffer(logger.getChild('fb_display'),
+                                        q_mp,
+                                        closing_event,
+                                        None,
+                                        opts)
+        cpu_0 = cpu_time()
+        await asyncio.gather(plot2FB.start_get_q_mp_data(),
+                             plot2FB.start_fb_plot())
+        result = plot2FB.results()
+        result['cpu_s'] = cpu_time() - cpu_0
+        result_q.put(('receiver', result))
+
+    asyncio.run(run())
+
+def start_bench_sender(q_mp, closing_event, port, result_q, ingest, batch_packets, screen_size=None):
+    logger = logging.getLogger(LOGGER_NAME)
+
+    async def run():
+        udp_server = AsyncUDPServer(logger.getChild('udp_server'),
+                                    BENCH_IP,
+                                    port,
+                                    q_mp,
+                                    closing_event,
+                                    {'bench_ip': BENCH_IP},
+                                    {BENCH_IP: 'bench_ip'},
+                                    stats_interval=0,
+                                    ingest=ingest,
+                                    batch_packets=batch_packets,
+                                    binner=None if screen_size is None else PhotonBinner(*screen_size))
+        cpu_0 = cpu_time()
+        transport, protocol = await udp_server.start_server()
+        while not closing_event.is_set():
+            await asyncio.sleep(0.05)
+        transport.close()
+        result_q.put(('sender', {'cpu_s': cpu_time() - cpu_0,
+                                 'ingest': protocol.stats.snapshot()}))
+
+    asyncio.run(run())
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind((BENCH_IP, 0))
+        return s.getsockname()[1]
+
+def run_scenario(opts, rate):
+    port = free_udp_port()
+    rcvr_opts = zodplot.argparser(['--noGPIO',
+                                   f'--display={opts.display}',
+                                   f'--updateTime={opts.updateTime}',
+                                   f'--maxBatch={opts.maxBatch}',
+                                   f'--transport={opts.transport}',
+                                   f'--zoomLevels={1 if opts.prebin else opts.zoomLevels}',
+                                   '--gain=25',
+                                   '--imgLog=/tmp/'])
+    screen_size = get_geometry(opts.display) if opts.prebin else None
+
+    if opts.transport == 'shm':
+        q_mp = PhotonRing(capacity=rcvr_opts.ringSize, max_batches=rcvr_opts.ringBatches,
+                          dtype=DELTA_DTYPE if opts.prebin else PHOTON_DTYPE)
+    else:
+        q_mp = Queue(maxsize=0)
+
+    closing_event = Event()
+    result_q = Queue()
+
+    receiver = Process(target=start_bench_receiver, args=(q_mp, closing_event, rcvr_opts, result_q))
+    sender = Process(target=start_bench_sender, args=(q_mp, closing_event, port, result_q, 
+                                                         opts.ingest, opts.batchPackets, screen_size))
+    receiver.start()
+    sender.start()
+    time.sleep(opts.warmup)
+
+    gen = TDCPacketGenerator(photons_per_packet=opts.photonsPerPacket,
+                             distribution=opts.dist,
+                             seed=opts.seed)
+    sent = send_packets(gen, (BENCH_IP, port), rate, opts.duration)
+
+    # Let the pipeline drain before stopping it
+    time.sleep(opts.drainTime)
+    closing_event.set()
+
+    results = {}
+    try:
+        for i in range(2):
+            stage, result = result_q.get(timeout=10)
+            results[stage] = result
+    except queue.Empty:
+        pass
+
+    sender.join(timeout=5)
+    receiver.join(timeout=5)
+    for proc in (sender, receiver):
+        if proc.is_alive():
+            proc.terminate()
+
+    if isinstance(q_mp, PhotonRing):
+        results['ring_overflow_photons'] = q_mp.overflow_records
+        q_mp.close()
+        q_mp.unlink()
+
+    rcvr = results.get('receiver', {})
+    photons_acc = rcvr.get('photons_accumulated', 0)
+    return {
+        'target_rate': rate,
+        'sent_photons': sent['photons'],
+        'sent_packets': sent['packets'],
+        'send_elapsed_s': sent['elapsed_s'],
+        'sent_rate': sent['photons'] / sent['elapsed_s'],
+        'sustained_rate': photons_acc / sent['elapsed_s'],
+        'drop_rate': 1 - photons_acc / max(sent['photons'], 1),
+        'sender': results.get('sender', {}),
+        'receiver': rcvr,
+        'ring_overflow_photons': results.get('ring_overflow_photons'),
+    }
+
+def argparser(argv):
+    if argv is None:
+        argv = sys.argv[1:]
+    if isinstance(argv, str):
+        argv = shlex.split(argv)
+
+    parser = argparse.ArgumentParser(sys.argv[0])
+    parser.add_argument('--rates', type=str, default='1e4,1e5,3e5',
+                        help='comma separated photon rates (photons/s), one scenario each')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds of traffic per scenario')
+    parser.add_argument('--warmup', type=float, default=1,
+                        help='seconds to let the processes start')
+    parser.add_argument('--drainTime', type=float, default=1,
+                        help='seconds to let the pipeline drain after sending')
+    parser.add_argument('--photonsPerPacket', type=int, default=200,
+                        help='photons per packet')
+    parser.add_argument('--dist', type=str, default='uniform', choices=DISTRIBUTIONS,
+                        help='photon X/Y distribution')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+    parser.add_argument('--display', type=str, default='offscreen:480x480x32',
+                        help='display backend spec')
+    parser.add_argument('--updateTime', type=int, default=34,
+                        help='screen update time (ms)')
+    parser.add_argument('--maxBatch', type=int, default=64,
+                        help='max packets/batches the display drains per wake-up')
+    parser.add_argument('--transport', type=str, default='queue', choices=['queue', 'shm'],
+                        help='sender -> receiver channel')
+    parser.add_argument('--ingest', type=str, default='protocol', choices=['protocol', 'batched'],
+                        help='UDP ingest mode')
+    parser.add_argument('--batchPackets', type=int, default=1,
+                        help='packets coalesced per message to the display process')
+    parser.add_argument('--zoomLevels', type=int, default=1,
+                        help='zoom levels the display accumulates')
+    parser.add_argument('--prebin', action='store_true',
+                        help='sender pre-bins photons into screen-pixel deltas (no zoom)')
+    parser.add_argument('--out', type=str, default=None,
+                        help='write the JSON results here instead of stdout')
+    opts = parser.parse_args(argv)
+
+    return opts
+
+def main(argv=None):
+    opts = argparser(argv)
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(logging.StreamHandler())
+
+    scenarios = []
+    for rate in [float(r) for r in opts.rates.split(',')]:
+        scenarios.append(run_scenario(opts, rate))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(opts),
+        'scenarios': scenarios,
+    }
+
+    if opts.out is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(opts.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# bpf_filter.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Classic BPF programs for the TDC socket: a socket filter that drops
+# datagrams from other sources, or too short to hold a TDC header, in the
+# kernel, and a SO_REUSEPORT program that shards sources across ingest
+# workers. Linux only.
+###############################################################################
+
+import socket
+import struct
+import ctypes
+
+SO_ATTACH_FILTER = 26
+SO_ATTACH_REUSEPORT_CBPF = 51
+
+# Classic BPF opcodes
+BPF_LD_W_ABS = 0x20   # A <- P[k:4]
+BPF_LD_W_LEN = 0x80   # A <- skb->len
+BPF_JEQ_K = 0x15      # pc += (A == k) ? jt : jf
+BPF_JGE_K = 0x35      # pc += (A >= k) ? jt : jf
+BPF_RET_K = 0x06      # accept k bytes (0 = drop)
+
+SKF_NET_OFF = -0x100000  # loads relative to the IP header
+IP_SRC_OFF = 12
+UDP_HEADER_LEN = 8  # a UDP socket filter sees the packet from the UDP header
+MAX_SOURCES = 250  # jump offsets are 8 bits
+
+ACCEPT = 0xFFFFFFFF
+DROP = 0
+
+def bpf_insn(code, jt, jf, k):
+    return struct.pack('HBBI', code, jt, jf, k & 0xFFFFFFFF)
+
+def build_source_filter(src_ips, min_payload=0):
+    # Accept datagrams from src_ips whose UDP payload is >= min_payload bytes
+    src_ips = list(src_ips)
+    if len(src_ips) > MAX_SOURCES:
+        raise ValueError(f'too many sources for one filter ({len(src_ips)})')
+
+    num = len(src_ips)
+    check_len = num + 2
+    prog = [bpf_insn(BPF_LD_W_ABS, 0, 0, SKF_NET_OFF + IP_SRC_OFF)]
+    for i, ip in enumerate(src_ips):
+        addr = int.from_bytes(socket.inet_aton(ip), 'big')
+        prog.append(bpf_insn(BPF_JEQ_K, check_len - (i + 2), 0, addr))
+    prog.append(bpf_insn(BPF_RET_K, 0, 0, DROP))
+
+    prog.append(bpf_insn(BPF_LD_W_LEN, 0, 0, 0))
+    prog.append(bpf_insn(BPF_JGE_K, 0, 1, UDP_HEADER_LEN + min_payload))
+    prog.append(bpf_insn(BPF_RET_K, 0, 0, ACCEPT))
+    prog.append(bpf_insn(BPF_RET_K, 0, 0, DROP))
+
+    return prog
+
+def build_shard_filter(src_ips, num_shards):
+    # SO_REUSEPORT socket selection: every datagram from the i-th source goes
+    # to socket i % num_shards of the group, so a source always lands on the
+    # same worker. Unknown sources go to socket 0 (its socket filter drops them).
+    src_ips = list(src_ips)
+    if len(src_ips) > MAX_SOURCES:
+        raise ValueError(f'too many sources for one filter ({len(src_ips)})')
+
+    prog = [bpf_insn(BPF_LD_W_ABS, 0, 0, SKF_NET_OFF + IP_SRC_OFF)]
+    for i, ip in enumerate(src_ips):
+        addr = int.from_bytes(socket.inet_aton(ip), 'big')
+        prog.append(bpf_insn(BPF_JEQ_K, 0, 1, addr))
+        prog.append(bpf_insn(BPF_RET_K, 0, 0, i % num_shards))
+    prog.append(bpf_insn(BPF_RET_K, 0, 0, 0))
+
+    return prog
+
+def set_filter(sock, option, prog):
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    insns = ctypes.create_string_buffer(b''.join(prog))
+    fprog = struct.pack('HP', len(prog), ctypes.addressof(insns))
+    sock.setsockopt(socket.SOL_SOCKET, option, fprog)
+
+def attach_filter(sock, prog):
+    set_filter(sock, SO_ATTACH_FILTER, prog)
+
+def attach_shard_filter(sock, prog):
+    # Applies to the whole SO_REUSEPORT group, any member can set it after
+    # bind (before bind it would start a group of its own)
+    set_filter(sock, SO_ATTACH_REUSEPORT_CBPF, prog)
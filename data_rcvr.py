@@ -1,8 +1,26 @@
 import time
+import queue
 import asyncio
-import pigpio as gpio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from frame_buffer import Framebuffer
-from ec11 import Encoder
+from accumulator import EXPOSURES, DELTA_DTYPE
+from frame_stats import FrameStats
+
+try:
+    import pigpio as gpio
+    from ec11 import Encoder
+except ImportError:  # headless (offscreen display, benchmarks)
+    gpio = None
+
+# How long the drain thread blocks before re-checking the closing event (s)
+DRAIN_TIMEOUT = 0.1
+
+# What the encoder knob adjusts, cycled by its push switch
+ENC_MODES = ('gain', 'zoom', 'pan_x', 'pan_y')
+PAN_STEPS = 32  # encoder detents across the detector when panning
+
+LONG_PRESS = 1000000  # us, holding CLEAR this long cycles the exposure mode
 
 class Plot2FrameBuffer():
 
@@ -16,9 +34,61 @@ class Plot2FrameBuffer():
 
         self.timer = time.time()
         self.update_time = opts.updateTime / 1000
+        self.max_batch = opts.maxBatch
+
+        # Frame pacing / latency instrumentation, logged every stats_interval s
+        self.stats_interval = opts.statsInterval
+        self.frame_stats = FrameStats()
+        self.pending_rcv_times = []  # batches accumulated since the last frame
+        self.pending_photons = []
+
+        # Photons per source index (the pad byte), names from tdc_dict
+        self.sources = opts.sources
+        self.src_photons = np.zeros(256, dtype=np.int64)
+
+        self.fb = Framebuffer(gain=opts.gain, 
+                              scr_shot_path=opts.imgLog, 
+                              stretch=opts.stretch, 
+                              display=opts.display,
+                              logger=self.logger,
+                              zoom_levels=opts.zoomLevels,
+                              split_sources=opts.split,
+                              overlay_height=opts.overlayHeight if opts.overlay else 0,
+                              rate_interval=opts.rateInterval)
+        self.fb.set_view(opts.zoom)
+        if self.fb.tiles is not None:
+            for src, x0, y0 in self.fb.tiles.tiles:
+                self.logger.info(f'split screen: {self.sources[src]} at ({x0}, {y0}), '
+                                 f'{self.fb.tiles.side}x{self.fb.tiles.side}')
+
+        self.exposure_time = opts.exposureTime
+        self.exposure_steps = opts.exposureSteps
+        self.fb.set_exposure(opts.exposure, self.exposure_time, self.exposure_steps)
+        # Set from the GPIO thread, applied by the render loop between frames
+        self.exposure_request = None
+        self.clear_request = False
+        self.clear_tick = None
+        self.enc_switches = 0  # knob presses, counted by the GPIO thread
+        self.enc_switches_done = 0
+
+        self.enc_mode = 0
+        self.enc_values = {
+            'gain': 1,
+            'zoom': self.fb.zoom,
+            'pan_x': PAN_STEPS // 2,
+            'pan_y': PAN_STEPS // 2,
+        }
+
+        # No GPIO map: run headless, buttons and knob disabled, fixed gain
+        if self.gpio_map is None:
+            self.zodpi = None
+            self.enc = None
+        else:
+            self.setup_gpio()
 
-        self.fb = Framebuffer(gain=opts.gain, scr_shot_path=opts.imgLog)
+        self.clr_count = 0
 
+    def setup_gpio(self):
         # Setup GPIO pins
         self.zodpi = gpio.pi()
 
@@ -38,84 +108,250 @@ class Plot2FrameBuffer():
                            switch=self.gpio_map['enc_switch'],
                            start_val=1,
                            min_val=1,
-                           max_val=40,)
+                           max_val=40,
+                           callback=self.enc_switch_cb)
 
-        self.clr_count = 0
+    def enc_range(self, mode):
+        if mode == 'gain':
+            return 1, 40
+        elif mode == 'zoom':
+            return 0, self.fb.pyramid.active_levels - 1
+        else:
+            return 0, PAN_STEPS
+
+    def enc_switch_cb(self, GPIO, level, tick):
+        # Applied by the render loop, so the mode never changes between its
+        # read of the knob and the set_range below
+        self.enc_switches += 1
+
+    def switch_enc_mode(self):
+        # Zoom and pan do nothing with a single level (--zoomLevels 1, --split,
+        # --prebin, rolling exposure), the knob then stays on gain
+        if self.fb.pyramid.active_levels == 1:
+            self.set_enc_mode(0)
+        else:
+            self.set_enc_mode((self.enc_mode + 1) % len(ENC_MODES))
+
+    def set_enc_mode(self, enc_mode):
+        # Park the knob's value in the current mode, load the new mode's
+        self.enc_values[ENC_MODES[self.enc_mode]] = self.enc.value
+        self.enc_mode = enc_mode
+        mode = ENC_MODES[self.enc_mode]
+        self.enc.set_range(self.enc_values[mode], *self.enc_range(mode))
+        self.logger.info(f'encoder: {mode}')
 
     def print_photon_count(self):
         self.logger.info('')
         self.logger.info(f'total photons:   {self.fb.num_photons_total}')
         self.logger.info(f'current photons: {self.fb.num_photons_current}')
+        for src in np.flatnonzero(self.src_photons):
+            name = self.sources[src] if src < len(self.sources) else f'source {src}'
+            self.logger.info(f'  {name}: {self.src_photons[src]}')
         
+    def drain_q_mp(self):
+        # Runs in the drain thread: block until something arrives, then take
+        # everything already pending (up to max_batch) in the same wake-up
+        batches = []
+        try:
+            batches.append(self.q_mp.get(timeout=DRAIN_TIMEOUT))
+            while len(batches) < self.max_batch:
+                batches.append(self.q_mp.get_nowait())
+        except queue.Empty:
+            pass
+
+        return batches
+
+    def process_batches(self, batches):
+        if len(batches) == 0:
+            return
+        elif len(batches) == 1:
+            photons = batches[0][1]
+        else:
+            photons = np.concatenate([photons for rcv_time, photons in batches])
+
+        if photons.dtype == DELTA_DTYPE:
+            # Pre-binned by the sender (--prebin)
+            self.fb.accumulate_deltas(photons)
+        else:
+            self.fb.accumulate_photons(photons['x'], photons['y'], photons['p'], photons['pad'])
+            self.src_photons += np.bincount(photons['pad'], minlength=len(self.src_photons))
+
+        for rcv_time, batch in batches:
+            rcv_times, num_photons = self.batch_marks(rcv_time, batch)
+            self.pending_rcv_times.extend(rcv_times)
+            self.pending_photons.extend(num_photons)
+
+    def batch_marks(self, rcv_time, photons):
+        # Receive time and photon count of each sender batch in a queue item.
+        # A shm ring get() merges the pending batches, rcv_time is then their
+        # marks: (end offset into photons, rcv_time) per batch.
+        if np.ndim(rcv_time) == 0:
+            if photons.dtype == DELTA_DTYPE:
+                return [rcv_time], [int(photons['n'].sum())]
+            return [rcv_time], [len(photons)]
+
+        ends = rcv_time['end'].astype(np.intp)
+        starts = np.concatenate(([0], ends[:-1]))
+        if photons.dtype == DELTA_DTYPE:
+            counts = np.concatenate(([0], np.cumsum(photons['n'], dtype=np.int64)))
+            return rcv_time['rcv_time'].tolist(), (counts[ends] - counts[starts]).tolist()
+        return rcv_time['rcv_time'].tolist(), (ends - starts).tolist()
+
+    def queue_backlog(self):
+        try:
+            return self.q_mp.qsize()
+        except NotImplementedError:  # multiprocessing.Queue on macOS
+            return None
+
+    def render_frame(self, rcv_times, num_photons):
+        # Runs on the render thread
+        t0 = time.perf_counter()
+        self.fb.update_fb()
+        render_s = time.perf_counter() - t0
+
+        self.frame_stats.frame(render_s, self.queue_backlog(), rcv_times,
+                               num_photons, time.time())
+
+    def log_frame_stats(self):
+        snap = self.frame_stats.snapshot()
+        self.logger.info(f'display: {self.frame_stats.format_snapshot(snap)}')
+
     async def start_get_q_mp_data(self):
         self.logger.info('... framebuffer display started')
+        loop = asyncio.get_running_loop()
+        drain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='q_mp_drain')
         try:
+            # Keep one drain in flight while the previous batches are processed
+            drain_fut = loop.run_in_executor(drain_executor, self.drain_q_mp)
             while not self.closing_event.is_set():
-                if not self.q_mp.empty():
-                    photon_list = self.q_mp.get()
-                    
-                    for photon in photon_list:                         
-                        x = (photon[1] << 8) + photon[0]
-                        y = (photon[3] << 8) + photon[2]
-                        p = photon[4]
-
-                        self.fb.raw_data_to_screen_mono(x, y, p, update=False)
-
-                await asyncio.sleep(0)
+                batches = await drain_fut
+                drain_fut = loop.run_in_executor(drain_executor, self.drain_q_mp)
+                self.process_batches(batches)
 
         except KeyboardInterrupt:
             self.closing_event.set()
         finally:
+            drain_executor.shutdown(wait=False)
             self.print_photon_count()
 
     async def start_fb_plot(self):
+        cb_list = []
+        render_executor = None
         try:
-            if not self.zodpi.connected:
+            if self.zodpi is None:
+                self.logger.info('running without GPIO')
+            elif not self.zodpi.connected:
                 self.logger.error('!!! GPIO not connected !!!')
-                cb_list = []
             else:
                 cb_list = self.setup_gpio_callbacks()
+
+            # Fixed-rate frames against absolute deadlines: render time does
+            # not stretch the period, and missed frames are skipped, not queued
+            loop = asyncio.get_running_loop()
+            render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fb_render')
+            next_frame = loop.time()
+            next_stats = next_frame + self.stats_interval
                 
             while not self.closing_event.is_set():
-                if self.enc.value == 0:
-                    gain = 1
-                elif self.enc.value > 0 and self.enc.value <= 40:
-                    gain = self.enc.value * 25
-                elif self.enc.value > 40:
-                    gain = 1000
+                if self.enc is None:
+                    gain = self.fb.gain
                 else:
-                    gain = 1
+                    while self.enc_switches_done < self.enc_switches:
+                        self.enc_switches_done += 1
+                        self.switch_enc_mode()
+                    if self.enc_mode != 0 and self.fb.pyramid.active_levels == 1:
+                        # Zoom went off (rolling exposure) while on zoom/pan
+                        self.set_enc_mode(0)
+                    self.enc_values[ENC_MODES[self.enc_mode]] = self.enc.value
+                    enc_gain = self.enc_values['gain']
+                    if enc_gain == 0:
+                        gain = 1
+                    elif enc_gain > 0 and enc_gain <= 40:
+                        gain = enc_gain * 25
+                    elif enc_gain > 40:
+                        gain = 1000
+                    else:
+                        gain = 1
+
+                    self.fb.set_view(self.enc_values['zoom'],
+                                     self.enc_values['pan_x'] / PAN_STEPS,
+                                     self.enc_values['pan_y'] / PAN_STEPS)
                
+                if self.exposure_request is not None:
+                    self.fb.set_exposure(self.exposure_request, self.exposure_time, self.exposure_steps)
+                    self.exposure_request = None
+                if self.clear_request:
+                    self.clear_request = False
+                    self.fb.reset_fb()
+
                 self.fb.gain = gain
-                self.fb.update_fb()
-                await asyncio.sleep(self.update_time)
+
+                # Blit on the render thread; the loop keeps accumulating
+                # photons until the frame is done
+                rcv_times, num_photons = self.pending_rcv_times, self.pending_photons
+                self.pending_rcv_times = []
+                self.pending_photons = []
+                await loop.run_in_executor(render_executor, self.render_frame,
+                                           rcv_times, num_photons)
+
+                now = loop.time()
+                if self.stats_interval and now >= next_stats:
+                    self.log_frame_stats()
+                    next_stats = now + self.stats_interval
+
+                next_frame += self.update_time
+                if now > next_frame:
+                    behind = int((now - next_frame) / self.update_time) + 1
+                    self.frame_stats.skipped += behind
+                    next_frame += behind * self.update_time
+                await asyncio.sleep(next_frame - now)
 
         except KeyboardInterrupt:
             self.closing_event.set()
         
         finally:
+            if render_executor is not None:
+                render_executor.shutdown(wait=True)
             try:
                 for cb in cb_list:
                     cb.cancel()
-                self.zodpi.stop()
+                if self.zodpi is not None:
+                    self.zodpi.stop()
             except Exception as e:
                 self.logger.error(f'{e}')
+            self.fb.close()
 
     def setup_gpio_callbacks(self):
         cb_list = []
         cb_list.append(self.zodpi.callback(self.gpio_map['clear'], 
-                                           gpio.FALLING_EDGE, 
+                                           gpio.EITHER_EDGE, 
                                            self.clear_screen_cb))
         
         cb_list.append(self.zodpi.callback(self.gpio_map['screenshot'], 
                                            gpio.FALLING_EDGE, 
                                            self.screenshot_cb))
+        return cb_list
 
     def clear_screen_cb(self, GPIO, level, tick):
-        self.fb.reset_fb()
-        self.clr_count += 1 
-        self.logger.info(f'reset count: {self.clr_count}')
+        # Acts on release: short press clears, long press cycles the exposure mode
+        if level == 0:
+            self.clear_tick = tick
+            return
+        elif self.clear_tick is None:
+            return
+
+        held = gpio.tickDiff(self.clear_tick, tick)
+        self.clear_tick = None
+        if held >= LONG_PRESS:
+            mode = EXPOSURES[(EXPOSURES.index(self.fb.exposure_mode) + 1) % len(EXPOSURES)]
+            self.exposure_request = mode
+            self.logger.info(f'exposure mode -> {mode}')
+        else:
+            self.clear_request = True
+            self.clr_count += 1 
+            self.logger.info(f'reset count: {self.clr_count}')
 
     def screenshot_cb(self, GPIO, level, tick):
-        self.fb.screenshot()
-        self.logger.info('*screenshot*')
\ No newline at end of file
+        name = self.fb.screenshot()
+        if name is not None:
+            self.logger.info(f'*screenshot* {name}')
\ No newline at end of file
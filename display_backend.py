@@ -0,0 +1,100 @@
+import os
+import mmap
+
+# Display used when none is given explicitly, e.g. 'offscreen:480x480x32'
+DISPLAY_ENV = 'ZODPLOT_DISPLAY'
+
+OFFSCREEN_WIDTH = 480
+OFFSCREEN_HEIGHT = 480
+
+def read_fbdev_geometry(fb_path='/dev/fb0', sys_path=None):
+    # (width, height, bits_pp) from sysfs
+    if sys_path is None:
+        sys_path = f'/sys/class/graphics/{os.path.basename(fb_path)}'
+
+    with open(f'{sys_path}/virtual_size', 'r') as f:
+        screen = f.read()
+        width, height = [int(i) for i in screen.split(',')]
+
+    with open(f'{sys_path}/bits_per_pixel', 'r') as f:
+        bits_pp = int(f.read()[:2])
+
+    return width, height, bits_pp
+
+class FbdevBackend():
+    # Linux framebuffer device, geometry from sysfs
+    def __init__(self, fb_path='/dev/fb0', sys_path=None):
+        self.width, self.height, self.bits_pp = read_fbdev_geometry(fb_path, sys_path)
+        self.bytes_pp = self.bits_pp // 8
+
+        self.path = fb_path
+        self.total_bytes = self.width * self.height * self.bytes_pp
+
+        fb_f = os.open(fb_path, os.O_RDWR)
+        self.fb = mmap.mmap(fb_f, self.total_bytes)
+        os.close(fb_f)
+
+class OffscreenBackend():
+    # Framebuffer in memory (path=None) or in an mmap'd file, for running
+    # and benchmarking the render path without a display
+    def __init__(self, width=OFFSCREEN_WIDTH, height=OFFSCREEN_HEIGHT, bits_pp=32, path=None):
+        self.width = width
+        self.height = height
+        self.bits_pp = bits_pp
+        self.bytes_pp = self.bits_pp // 8
+
+        self.path = path
+        self.total_bytes = self.width * self.height * self.bytes_pp
+
+        if path is None:
+            self.fb = mmap.mmap(-1, self.total_bytes)
+        else:
+            fb_f = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(fb_f).st_size < self.total_bytes:
+                os.ftruncate(fb_f, self.total_bytes)
+            self.fb = mmap.mmap(fb_f, self.total_bytes)
+            os.close(fb_f)
+
+def get_geometry(spec=None, fb_path='/dev/fb0'):
+    # (width, height) of a display spec without opening the display, for
+    # processes that only need to know the screen size (pre-binning)
+    if spec is None:
+        spec = os.environ.get(DISPLAY_ENV, 'fbdev')
+
+    kind, _, args = spec.partition(':')
+
+    if kind == 'fbdev':
+        width, height, bits_pp = read_fbdev_geometry(args if args else fb_path)
+        return width, height
+
+    elif kind == 'offscreen':
+        geometry, _, path = args.partition(':')
+        if geometry:
+            width, height, bits_pp = [int(i) for i in geometry.split('x')]
+            return width, height
+        else:
+            return OFFSCREEN_WIDTH, OFFSCREEN_HEIGHT
+
+    else:
+        raise ValueError(f'unknown display \'{spec}\'')
+
+def get_backend(spec=None, fb_path='/dev/fb0'):
+    # spec: 'fbdev[:<device>]' or 'offscreen[:<W>x<H>x<bpp>[:<file>]]'
+    if spec is None:
+        spec = os.environ.get(DISPLAY_ENV, 'fbdev')
+
+    kind, _, args = spec.partition(':')
+
+    if kind == 'fbdev':
+        return FbdevBackend(args if args else fb_path)
+
+    elif kind == 'offscreen':
+        geometry, _, path = args.partition(':')
+        if geometry:
+            width, height, bits_pp = [int(i) for i in geometry.split('x')]
+            return OffscreenBackend(width, height, bits_pp, path if path else None)
+        else:
+            return OffscreenBackend()
+
+    else:
+        raise ValueError(f'unknown display \'{spec}\'')
@@ -31,8 +31,10 @@ class Encoder:
             self.pi_gpio.callback(self.pin_lo, gpio.EITHER_EDGE, self.rotary_cb))
         self.cb_list.append(
             self.pi_gpio.callback(self.pin_hi, gpio.EITHER_EDGE, self.rotary_cb))
+        # The push switch resets the value, unless a callback takes it over
         self.cb_list.append(
-            self.pi_gpio.callback(self.pin_switch, gpio.FALLING_EDGE, self.reset_value))
+            self.pi_gpio.callback(self.pin_switch, gpio.FALLING_EDGE, 
+                                  self.reset_value if self.callback is None else self.callback))
     
     def get_status(self):
         return self.value, self.direction
@@ -42,6 +44,11 @@ class Encoder:
         self.prev_state = 0b11
         self.direction = None
 
+    def set_range(self, value, min_val=None, max_val=None):
+        self.min_val = min_val
+        self.max_val = max_val
+        self.value = value
+
     def rotary_cb(self, GPIO, level, tick):
         new_state = self.pi_gpio.read(self.pin_hi) \
                   + (self.pi_gpio.read(self.pin_lo) << 1)
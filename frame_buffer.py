@@ -1,67 +1,353 @@
 import time
-import os
-import mmap
-import subprocess
+import threading
 import numpy as np
+from display_backend import get_backend
+from screenshot_writer import ScreenshotWriter
+from accumulator import PhotonPyramid, RollingExposure, DecayExposure, SourceTiles, MAX_ROLLING_BYTES
+from overlay import StatsOverlay, image_area
+
+# Tone curves available for the display LUT
+STRETCHES = ('linear', 'sqrt', 'log', 'asinh')
+STRETCH_SOFTENING = 1000.0  # how hard log/asinh compress the bright end
+MAX_LUT_LEN = 2 ** 16  # longer LUTs are indexed with (energy >> shift)
+MAX_DIRTY_SPANS = 16  # past this, blit one span from first to last dirty row
 
 class Framebuffer():
     def __init__(self, fb_path="/dev/fb0", src_size_bit_depth=14, gain=1,
-                 scr_shot_path='/home/idg/imgs/'):
+                 scr_shot_path='/home/idg/imgs/', stretch='linear', display=None, logger=None,
+                 zoom_levels=1, split_sources=None, overlay_height=0, rate_interval=1.0):
 
         self.gain = gain
+        self.stretch = stretch
         self.scr_shot_path = scr_shot_path
+        self.logger = logger
+        self.screenshot_writer = None  # started on the first screenshot
 
-        with open("/sys/class/graphics/fb0/virtual_size", "r") as f:
-            screen = f.read()
-            self.width, self.height = [int(i) for i in screen.split(",")]
+        # Display backend: a display_backend object or spec string,
+        # None uses $ZODPLOT_DISPLAY or falls back to fb_path
+        if display is None or isinstance(display, str):
+            display = get_backend(display, fb_path)
+        self.display = display
 
-        with open("/sys/class/graphics/fb0/bits_per_pixel", "r") as f:
-            self.bits_pp = int(f.read()[:2])
-            self.bytes_pp = self.bits_pp // 8
+        # With the stats overlay the image is a square above the strip
+        self.screen_width = self.display.width
+        self.screen_height = self.display.height
+        img_x0, self.width, self.height = image_area(self.screen_width, self.screen_height,
+                                                     overlay_height)
+        self.bits_pp = self.display.bits_pp
+        self.bytes_pp = self.display.bytes_pp
 
-        self.total_bytes = self.width * self.height * self.bytes_pp
+        self.total_bytes = self.display.total_bytes
         self.size_ratio = (self.width - 1) / (2 ** src_size_bit_depth - 1)
         self.p_ratio = self.size_ratio ** 2
-        
-        fb_f = os.open(fb_path, os.O_RDWR)
-        self.fb = mmap.mmap(fb_f, 
-                            self.total_bytes)
-        self.fb_buf = np.ndarray(shape=(self.height, self.width, self.bytes_pp), 
-                                    dtype=np.single)
-        self.fb_buf[:] = 0.0
+
+        self.fb = self.display.fb
+
+        # Mono accumulation planes: summed raw photon P per pixel, level k at
+        # 2^k x screen resolution (zoom). fb_buf is level 0, the whole
+        # detector at screen size. p_ratio and gain are applied through the
+        # LUT at blit time.
+        # Split screen: one tile of level 0 per source in split_sources
+        # (indexes into tdc_dict), no zoom
+        self.tiles = None
+        if split_sources:
+            self.tiles = SourceTiles(self.width, self.height, split_sources, src_size_bit_depth)
+            self.p_ratio = self.tiles.scale ** 2
+            zoom_levels = 1
+
+        self.pyramid = PhotonPyramid(self.width, self.height, src_size_bit_depth, zoom_levels)
+        self.fb_buf = self.pyramid.levels[0]
+
+        # Displayed window: zoom level and its top-left on that level
+        self.zoom = 0
+        self.win = (0, 0)
+        self.view = self.fb_buf
+
+        # Exposure mode: 'infinite', or a rolling window / decay stepped
+        # every step_time s from update_fb
+        self.exposure_mode = 'infinite'
+        self.exposure = None
+        self.window_view = None
+        self.step_time = None
+        self.next_step = None
+
+        # Reusable views of the mmap'd framebuffer. At 32 bpp every pixel is
+        # one uint32 (B, G, R, 0), so the LUT can emit whole pixels directly.
+        if self.bits_pp == 32:
+            self.screen_view = np.frombuffer(self.fb, dtype=np.uint32).reshape(self.screen_height,
+                                                                               self.screen_width)
+        else:
+            self.screen_view = np.frombuffer(self.fb, dtype=np.uint8).reshape(self.screen_height,
+                                                                              self.screen_width,
+                                                                              self.bytes_pp)
+        self.fb_view = self.screen_view[:self.height, img_x0:img_x0+self.width]
+
+        # PHA histogram / count-rate strip along the bottom of the screen
+        self.overlay = None
+        if overlay_height > 0:
+            self.screen_view[:] = 0
+            self.overlay = StatsOverlay(self.screen_view[self.screen_height-overlay_height:],
+                                        self.bits_pp, rate_interval, logger)
+
+        # Preallocated blit buffers, reused every frame. snap_buf holds the
+        # rows copied out of the accumulator under the lock for the blit.
+        self.snap_buf = np.zeros((self.height, self.width), dtype=np.uint32)
+        self.lut_idx = np.empty((self.height, self.width), dtype=np.intp)
+        self.px_buf = np.empty((self.height, self.width), dtype=np.uint8)
+
+        # Rows touched since the last blit
+        self.dirty_rows = np.zeros(self.height, dtype=bool)
+        self.full_redraw = True
+
+        # Guards the planes, view and dirty state: accumulation and the
+        # snapshot taken at the start of a frame may run on different threads
+        self.lock = threading.Lock()
+
+        self.lut = None
+        self.lut_shift = 0
+        self.lut_gain = None
+        self.lut_stretch = None
+        self.lut_zoom = None
+        self.build_lut()
 
         self.num_photons_total = self.num_photons_current = 0
 
+    def build_lut(self):
+        # Display value (linear, before clipping) = energy * p_ratio * gain,
+        # with p_ratio of the zoom level shown so brightness holds when zooming
+        # (or of the tiles: split-screen photons are scaled to the tile)
+        if self.tiles is not None:
+            scale = self.tiles.scale ** 2 * self.gain
+        else:
+            scale = self.pyramid.scales[self.zoom] ** 2 * self.gain
+        energy_sat = int(np.ceil(255.0 / scale))  # energy where the display saturates
+        self.lut_shift = max(0, energy_sat.bit_length() - MAX_LUT_LEN.bit_length() + 1)
+        lut_len = (energy_sat >> self.lut_shift) + 1
+
+        energy = np.arange(lut_len, dtype=np.float64) * (1 << self.lut_shift)
+        x = np.clip(energy * scale / 255.0, 0.0, 1.0)
+
+        if self.stretch == 'sqrt':
+            y = np.sqrt(x)
+        elif self.stretch == 'log':
+            y = np.log1p(STRETCH_SOFTENING * x) / np.log1p(STRETCH_SOFTENING)
+        elif self.stretch == 'asinh':
+            y = np.arcsinh(STRETCH_SOFTENING * x) / np.arcsinh(STRETCH_SOFTENING)
+        else:
+            y = x
+
+        self.lut = (y * 255.0 + 0.5).astype(np.uint8)
+        self.lut[-1] = 255
+        if self.bits_pp == 32:
+            # Expand to packed grey pixels: same value in B, G and R, 0 in the 4th byte
+            lut_px = self.lut.astype(np.uint32)
+            self.lut = lut_px | (lut_px << 8) | (lut_px << 16)
+        self.lut_gain = self.gain
+        self.lut_stretch = self.stretch
+        self.lut_zoom = self.zoom
+
+    def set_view(self, zoom, cx=0.5, cy=0.5):
+        # Zoom 2^zoom, centred on (cx, cy) as fractions of the detector
+        zoom = min(max(int(zoom), 0), self.pyramid.active_levels - 1)
+        win = self.pyramid.window(zoom, cx, cy)
+        if zoom != self.zoom or win != self.win:
+            with self.lock:
+                self.zoom = zoom
+                self.win = win
+                self.update_views()
+
+    def update_views(self):
+        self.view = self.pyramid.view(self.zoom, *self.win)
+        if self.exposure is None:
+            self.window_view = None
+        else:
+            self.window_view = self.exposure.window_view(self.zoom, *self.win)
+        self.full_redraw = True
+
+    def set_exposure(self, mode, exposure_time=10, steps=10):
+        # rolling: show the last exposure_time s, in `steps` sub-frames
+        # decay:   time constant exposure_time s, applied in `steps` steps
+        if mode == 'rolling':
+            nbytes = RollingExposure.ring_bytes(self.pyramid, steps)
+            if nbytes > MAX_ROLLING_BYTES:
+                if self.logger is not None:
+                    self.logger.error(f'rolling exposure needs {nbytes / 2**20:.0f} MiB '
+                                      f'(max {MAX_ROLLING_BYTES / 2**20:.0f} MiB), '
+                                      f'staying in {self.exposure_mode}')
+                return False
+            exposure = RollingExposure(self.pyramid, steps)
+        elif mode == 'decay':
+            exposure = DecayExposure(self.pyramid, np.exp(-1 / steps))
+        else:
+            exposure = None
+
+        with self.lock:
+            if self.exposure is not None:
+                self.exposure.fold()
+
+            if isinstance(self.exposure, RollingExposure):
+                # The zoom levels missed the rolling period: restart them
+                for plane in self.pyramid.levels[1:]:
+                    plane[:] = 0
+                self.pyramid.active_levels = self.pyramid.num_levels
+            if isinstance(exposure, RollingExposure):
+                # Level 0 only while rolling
+                self.pyramid.active_levels = 1
+                self.zoom = 0
+                self.win = (0, 0)
+
+            self.exposure = exposure
+            self.exposure_mode = mode
+            self.step_time = exposure_time / steps
+            self.next_step = time.time() + self.step_time
+            self.update_views()
+
+        if self.logger is not None:
+            self.logger.info(f'exposure: {mode}, {exposure_time} s in {steps} steps '
+                             f'({0 if self.exposure is None else self.exposure.nbytes / 2**20:.0f} MiB)')
+        return True
+
+    def step_exposure(self):
+        now = time.time()
+        if self.exposure is None or now < self.next_step:
+            return
+
+        self.exposure.step()
+        self.full_redraw = True
+        self.next_step += self.step_time
+        if self.next_step < now:
+            # Fell behind (slow frame): don't try to catch up
+            self.next_step = now + self.step_time
+
     def get_max_pixel(self):
         self.fb.seek(0)
         all_bytes = self.fb.read(self.total_bytes)
         max_px = max(all_bytes)
         return max_px
 
+    def get_screen(self):
+        # 8-bit copy of what is on screen (the display is grey, one channel)
+        if self.bits_pp == 32:
+            return (self.screen_view & 0xFF).astype(np.uint8)
+        return self.screen_view[:, :, 0].copy()
+
+    def get_counts(self):
+        # Copy of the whole-detector (level 0) counts as currently displayed
+        with self.lock:
+            if self.window_view is None:
+                return self.fb_buf.copy()
+            return self.fb_buf + self.exposure.window[0]
+
     def screenshot(self):
-        filename = time.strftime("%Y%m%d_%H%M%S")
-        filepath = f'{self.scr_shot_path}{filename}.cap'
-        subprocess.run(['cp', '/dev/fb0', filepath])
+        # Copy now, compress and write (NPZ of the raw plane + PNG of the
+        # screen) on the writer thread so the caller never waits on disk
+        if self.screenshot_writer is None:
+            self.screenshot_writer = ScreenshotWriter(self.scr_shot_path, self.logger)
+
+        meta = {
+            'time': time.time(),
+            'gain': self.gain,
+            'stretch': self.stretch,
+            'exposure': self.exposure_mode,
+            'p_ratio': self.p_ratio,
+            'photons_total': self.num_photons_total,
+            'photons_current': self.num_photons_current,
+        }
+        if self.tiles is not None:
+            meta['tile_side'] = self.tiles.side
+            meta['tiles'] = np.array(self.tiles.tiles)
+        return self.screenshot_writer.submit(self.get_counts(), self.get_screen(), meta)
+
+    def close(self):
+        # Let pending screenshots finish writing
+        if self.screenshot_writer is not None:
+            self.screenshot_writer.close()
+            self.screenshot_writer = None
 
     def write_bytes_to_fb(self, bytes_):
         self.fb.seek(0)
         self.fb.write(bytes_)
+        # The display no longer matches the plane
+        self.full_redraw = True
+        if self.overlay is not None:
+            self.overlay.full_redraw = True
 
-    def update_fb(self):
-        buf_tmp = self.fb_buf * self.gain
-        buf_tmp_flat = buf_tmp.reshape(-1)
-        # buf_tmp_int = (buf_tmp_flat + 0.5).astype(np.uint8)
-        # buf_tmp_ready = np.clip(buf_tmp_int, 0, 255)
-        buf_tmp_clip = np.clip(buf_tmp_flat, 0.0, 255.0)
-        buf_tmp_ready = (buf_tmp_clip + 0.5).astype(np.uint8)
-        self.fb.seek(0)
-        self.fb.write(buf_tmp_ready)
+    def get_dirty_spans(self):
+        rows = np.flatnonzero(self.dirty_rows)
+        if len(rows) == 0:
+            return []
 
-    def _write_px_to_buf(self, x, y, r=255, g=255, b=255, t=0):
+        breaks = np.flatnonzero(np.diff(rows) > 1)
+        if len(breaks) >= MAX_DIRTY_SPANS:
+            return [(rows[0], rows[-1] + 1)]
+
+        starts = [rows[0]] + (rows[breaks + 1]).tolist()
+        ends = (rows[breaks] + 1).tolist() + [rows[-1] + 1]
+        return list(zip(starts, ends))
+
+    def _snapshot_rows(self, lo, hi):
+        if self.window_view is None:
+            self.snap_buf[lo:hi] = self.view[lo:hi]
+        else:
+            # Rolling exposure: completed sub-frames + the current one
+            np.add(self.window_view[lo:hi], self.view[lo:hi], out=self.snap_buf[lo:hi])
+
+    def _blit_rows(self, lo, hi):
+        # intp index and mode='clip' (which also saturates past the LUT's
+        # end) so np.take neither converts the index nor buffers the output
+        lut_idx = self.lut_idx[lo:hi]
+        np.right_shift(self.snap_buf[lo:hi], self.lut_shift, out=lut_idx)
+
+        # Expand the single plane to the display's pixel format on the way out
         if self.bits_pp == 32:
-            self.fb_buf[y, x] += [b, g, r, t]
+            np.take(self.lut, lut_idx, out=self.fb_view[lo:hi], mode='clip')
         else:
-            self.fb_buf[y, x] += [r, g, b]
+            px_buf = self.px_buf[lo:hi]
+            np.take(self.lut, lut_idx, out=px_buf, mode='clip')
+            self.fb_view[lo:hi, :, :3] = px_buf[:, :, np.newaxis]
+
+    def update_fb(self):
+        # Only the copy of the changed rows happens under the lock; the LUT
+        # conversion and the write to the display run alongside accumulation
+        with self.lock:
+            self.step_exposure()
+
+            # The LUT is only rebuilt when the gain (encoder), stretch or zoom changes
+            if self.gain != self.lut_gain or self.stretch != self.lut_stretch \
+                    or self.zoom != self.lut_zoom:
+                self.build_lut()
+                self.full_redraw = True
+
+            if self.full_redraw:
+                spans = [(0, self.height)]
+            else:
+                spans = self.get_dirty_spans()
+
+            self.dirty_rows[:] = False
+            self.full_redraw = False
+
+            for lo, hi in spans:
+                self._snapshot_rows(lo, hi)
+
+            if self.overlay is not None:
+                pha_counts = self.overlay.pha_counts.copy()
+                sampled = self.overlay.sample(time.time())
+
+        for lo, hi in spans:
+            self._blit_rows(lo, hi)
+
+        if self.overlay is not None:
+            self.overlay.draw(pha_counts, sampled)
+
+    def _to_energy(self, r, g, b):
+        # The plane is mono: a colour collapses to its brightest channel,
+        # in the same (pre-gain) units the float buffer used to hold
+        return int(max(r, g, b) / self.p_ratio + 0.5)
+
+    def _write_px_to_buf(self, x, y, r=255, g=255, b=255, t=0):
+        with self.lock:
+            self.fb_buf[y, x] += self._to_energy(r, g, b)
+            self.dirty_rows[y] = True
 
     def write_px(self, x, y, r=255, g=255, b=255, t=0, update=True):
         self._write_px_to_buf(x, y, r, g, b, t)
@@ -69,44 +355,83 @@ class Framebuffer():
             self.update_fb()
 
     def fill_row(self, y, r=255, g=255, b=255, t=0):
-        if self.bits_pp == 32:
-            self.fb_buf[y, :] = [b, g, r, t]
-        else:
-            self.fb_buf[y, :] = [r, g, b]
-        
+        with self.lock:
+            self.fb_buf[y, :] = self._to_energy(r, g, b)
+            self.dirty_rows[y] = True
+
         self.update_fb()
-        
+
     def fill_column(self, x, r=255, g=255, b=255, t=0):
-        if self.bits_pp == 32:
-            self.fb_buf[: ,x] = [b, g, r, t]
-        else:
-            self.fb_buf[: ,x] = [r, g, b]
-        
+        with self.lock:
+            self.fb_buf[: ,x] = self._to_energy(r, g, b)
+            self.full_redraw = True
+
         self.update_fb()
-        
-    def fill_screen(self, r=255, g=255, b=255, t=0):    
-        if self.bits_pp == 32:
-            self.fb_buf[:] = [b, g, r, t]
-        else:
-            self.fb_buf[:] = [r, g, b]
-        
+
+    def fill_screen(self, r=255, g=255, b=255, t=0):
+        with self.lock:
+            self.fb_buf[:] = self._to_energy(r, g, b)
+            self.full_redraw = True
+
         self.update_fb()
 
     def clear_screen(self):
-        self.fill_screen(0, 0, 0, 0)
-        self.num_photons_current = 0
+        with self.lock:
+            self.pyramid.clear()
+            if self.exposure is not None:
+                self.exposure.clear()
+            if self.overlay is not None:
+                self.overlay.clear()
+            self.full_redraw = True
+            self.num_photons_current = 0
+
+        self.update_fb()
 
     def raw_data_to_screen_mono(self, x, y, p, update=False):
-        self.num_photons_current += 1
-        self.num_photons_total += 1
+        self.accumulate_photons(np.array([x]), np.array([y]), np.array([p]), np.array([0]))
+        if update:
+            self.update_fb()
+
+    def accumulate_photons(self, xs, ys, ps, srcs=None):
+        # Scale, round and accumulate a whole batch of photons at once, on
+        # every zoom level. Anything off the detector (bad packets) is dropped.
+        # Split screen: photons go to their source's tile (srcs = pad byte).
+        with self.lock:
+            if self.tiles is None:
+                hits = self.pyramid.accumulate(xs, ys, ps)
+            else:
+                hits = [self.pyramid.add_pixels(0, *self.tiles.place(xs, ys, ps, srcs))]
+
+            # Counts and the overlay only see photons that landed on level 0
+            p = hits[0][2]
+            self.num_photons_current += len(p)
+            self.num_photons_total += len(p)
+            if self.overlay is not None:
+                self.overlay.add(len(p), p)
+
+            # Only rows of the displayed window need redrawing
+            x, y, p = hits[self.zoom]
+            x0, y0 = self.win
+            if self.zoom > 0:
+                inside = (x >= x0) & (x < x0 + self.width) & (y >= y0) & (y < y0 + self.height)
+                y = y[inside]
+            self.dirty_rows[y - y0] = True
+
+    def accumulate_deltas(self, deltas):
+        # Sender pre-binned pixels (accumulator.DELTA_DTYPE): one scatter-add
+        # into level 0. Zoom levels are not fed, pre-binning runs without zoom.
+        with self.lock:
+            self.pyramid.add_flat(0, deltas['idx'], deltas['p'])
 
-        x_screen = int((x * self.size_ratio) + 0.5)
-        y_screen = int((y * self.size_ratio) + 0.5)
+            num_photons = int(deltas['n'].sum())
+            self.num_photons_current += num_photons
+            self.num_photons_total += num_photons
+            if self.overlay is not None:
+                self.overlay.add(num_photons)
 
-        p_screen = p * self.p_ratio
-        
-        self.write_px(x_screen, y_screen, p_screen, p_screen, p_screen, 0, update)
+            if self.zoom == 0:
+                self.dirty_rows[deltas['idx'] // self.width] = True
 
     def reset_fb(self):
         # self.screenshot()
-        self.clear_screen()
\ No newline at end of file
+        self.clear_screen()
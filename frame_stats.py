@@ -0,0 +1,97 @@
+# frame_stats.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Render loop instrumentation: frame time, queue backlog and
+# photon-to-pixel latency, kept as histograms per logging interval.
+###############################################################################
+
+import time
+import numpy as np
+
+# Log-spaced bins, 0.1 ms .. 10 s (+ underflow/overflow)
+HIST_EDGES_MS = np.geomspace(0.1, 10000, 51)
+PERCENTILES = (50, 90, 99)
+
+class Histogram():
+    def __init__(self, edges=HIST_EDGES_MS):
+        self.edges = edges
+        self.counts = np.zeros(len(edges) + 1, dtype=np.int64)
+        self.max = 0.0
+
+    def add(self, values, weights=None):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        bins = np.searchsorted(self.edges, values, side='right')
+        self.counts += np.bincount(bins, weights=weights, minlength=len(self.counts)).astype(np.int64)
+        self.max = max(self.max, float(values.max()))
+
+    def percentile(self, pct):
+        # Upper edge of the bin holding the pct-th sample
+        total = self.counts.sum()
+        if total == 0:
+            return None
+        idx = int(np.searchsorted(np.cumsum(self.counts), total * pct / 100))
+        if idx >= len(self.edges):
+            return self.max
+        return min(float(self.edges[idx]), self.max)
+
+    def summary(self):
+        result = {f'p{pct}': self.percentile(pct) for pct in PERCENTILES}
+        result['max'] = self.max if self.counts.sum() else None
+        return result
+
+    def reset(self):
+        self.counts[:] = 0
+        self.max = 0.0
+
+class FrameStats():
+    def __init__(self):
+        self.render_ms = Histogram()
+        self.latency_ms = Histogram()  # photon-weighted
+        self.reset()
+
+    def reset(self):
+        self.t_start = time.time()
+        self.frames = 0
+        self.skipped = 0
+        self.backlog_max = 0
+        self.backlog_sum = 0
+        self.render_ms.reset()
+        self.latency_ms.reset()
+
+    def frame(self, render_s, backlog, rcv_times, num_photons, now):
+        # One rendered frame: its render time, the queue depth behind it and
+        # the receive times (+ photon counts) of the batches it first showed
+        self.frames += 1
+        self.render_ms.add([render_s * 1000])
+        if backlog is not None:
+            self.backlog_max = max(self.backlog_max, backlog)
+            self.backlog_sum += backlog
+        if len(rcv_times) > 0:
+            self.latency_ms.add((now - np.asarray(rcv_times)) * 1000, weights=num_photons)
+
+    def snapshot(self):
+        # Stats since the last snapshot, then start a new interval
+        dt = max(time.time() - self.t_start, 1e-9)
+        snap = {
+            'fps': self.frames / dt,
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'render_ms': self.render_ms.summary(),
+            'latency_ms': self.latency_ms.summary(),
+            'backlog_max': self.backlog_max,
+            'backlog_mean': self.backlog_sum / max(self.frames, 1),
+        }
+        self.reset()
+        return snap
+
+    def format_snapshot(self, snap):
+        def fmt(summary):
+            return ' '.join(f'{k}={"-" if v is None else f"{v:.1f}"}' for k, v in summary.items())
+
+        return (f'{snap["fps"]:.1f} fps, skipped={snap["skipped"]} | '
+                f'render ms: {fmt(snap["render_ms"])} | '
+                f'latency ms: {fmt(snap["latency_ms"])} | '
+                f'backlog max={snap["backlog_max"]} mean={snap["backlog_mean"]:.1f}')
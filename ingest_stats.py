@@ -0,0 +1,207 @@
+# ingest_stats.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Packet-loss / sequence-gap accounting for the UDP ingest path.
+###############################################################################
+
+import os
+import time
+
+PKT_COUNT_MOD = 2 ** 16  # the TDC packet counter is 16 bits
+SEQ_WINDOW = 1024  # recent packet counts remembered for reorder/duplicate checks
+RESTART_RUN = 2  # consecutive counts already seen that mean the TDC restarted
+
+def read_kernel_drops(sock, proc_path='/proc/net/udp'):
+    # Datagrams the kernel dropped for this socket, from the 'drops' column
+    # of /proc/net/udp: receive buffer overflows plus anything a socket
+    # filter rejected. None if unavailable.
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        with open(proc_path, 'r') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[-1])
+    except (OSError, IndexError, ValueError):
+        pass
+
+    return None
+
+def read_rcvbuf_errors(proc_path='/proc/net/snmp'):
+    # UDP datagrams dropped because a receive buffer was full, system-wide.
+    # None if unavailable.
+    try:
+        with open(proc_path, 'r') as f:
+            udp = [line.split() for line in f if line.startswith('Udp:')]
+        return int(udp[1][udp[0].index('RcvbufErrors')])
+    except (OSError, IndexError, ValueError):
+        return None
+
+class SequenceTracker():
+    # Tracks one source's 16-bit packet counter, including wraparound
+    def __init__(self):
+        self.last_count = None
+        self.seen = 0  # bit i set = (last_count - i) was received
+
+        self.packets = 0
+        self.lost = 0  # packets skipped over and not (yet) seen late
+        self.reordered = 0
+        self.duplicates = 0
+        self.resets = 0
+
+        self.dup_run = 0  # consecutive counts in a row that were already seen
+        self.dup_last = None
+
+    def update(self, pkt_count):
+        # Returns False if the packet is a duplicate and should be dropped
+        if self.last_count is None:
+            self.restart(pkt_count)
+            self.packets += 1
+            return True
+
+        ahead = (pkt_count - self.last_count) % PKT_COUNT_MOD
+        behind = PKT_COUNT_MOD - ahead
+
+        if ahead == 0 or (behind < SEQ_WINDOW and self.seen & (1 << behind)):
+            return self.duplicate(pkt_count)
+        self.dup_run = 0
+
+        if ahead < PKT_COUNT_MOD // 2:
+            if ahead >= SEQ_WINDOW and pkt_count < min(self.last_count, SEQ_WINDOW):
+                # Past the window onto a low count: a restart, not a wrap
+                # (a wrap that lost over SEQ_WINDOW packets reads the same)
+                self.resets += 1
+                self.restart(pkt_count)
+            else:
+                # Newer packet (possibly after wrapping 65535 -> 0)
+                self.lost += ahead - 1
+                self.seen = ((self.seen << ahead) | 1) & ((1 << SEQ_WINDOW) - 1)
+                self.last_count = pkt_count
+
+        elif behind < SEQ_WINDOW:
+            # Older packet arriving late
+            self.seen |= 1 << behind
+            self.reordered += 1
+            self.lost = max(self.lost - 1, 0)
+
+        else:
+            # Too far back to be late, the TDC was most likely restarted
+            self.resets += 1
+            self.restart(pkt_count)
+
+        self.packets += 1
+        return True
+
+    def duplicate(self, pkt_count):
+        if self.dup_run > 0 and pkt_count == (self.dup_last + 1) % PKT_COUNT_MOD:
+            self.dup_run += 1
+        else:
+            self.dup_run = 1
+        self.dup_last = pkt_count
+
+        if self.dup_run < RESTART_RUN:
+            self.duplicates += 1
+            return False
+
+        # A run of counts already in the window: the TDC restarted from a
+        # count the window still covers. The run's earlier packets were
+        # dropped as duplicates, they were lost.
+        self.duplicates -= RESTART_RUN - 1
+        self.lost += RESTART_RUN - 1
+        self.resets += 1
+        self.restart(pkt_count)
+        self.packets += 1
+        return True
+
+    def restart(self, pkt_count):
+        self.last_count = pkt_count
+        self.seen = 1
+        self.dup_run = 0
+
+class IngestStats():
+    def __init__(self):
+        self.trackers = {}
+
+        self.packets = 0
+        self.bytes = 0
+        self.photons = 0
+        self.unknown_src = 0
+        self.misaligned = 0
+        self.truncated = 0
+        self.queue_drops = 0
+        self.kernel_drops = None  # socket receive buffer overflows, if known
+        self.filtered = 0  # datagrams rejected by the kernel source filter
+
+        # With a socket filter attached the socket's drop counter also counts
+        # rejected datagrams; buffer overflows are taken from RcvbufErrors
+        self.socket_drops = None
+        self.rcvbuf_base = None
+
+        self.last_snapshot = (time.time(), 0, 0, 0)
+
+    def track(self, src, pkt_count):
+        tracker = self.trackers.get(src)
+        if tracker is None:
+            tracker = self.trackers[src] = SequenceTracker()
+        return tracker.update(pkt_count)
+
+    def use_rcvbuf_errors(self):
+        # Call when a socket filter is attached, before any traffic
+        self.rcvbuf_base = read_rcvbuf_errors()
+
+    def update_kernel_drops(self):
+        if self.socket_drops is None:
+            return
+        if self.rcvbuf_base is None:
+            self.kernel_drops = self.socket_drops
+            return
+
+        # RcvbufErrors is system-wide: only the part this socket can account for
+        rcvbuf_errors = read_rcvbuf_errors()
+        if rcvbuf_errors is None:
+            self.kernel_drops = None
+            return
+        self.kernel_drops = min(self.socket_drops, rcvbuf_errors - self.rcvbuf_base)
+        self.filtered = self.socket_drops - self.kernel_drops
+
+    def snapshot(self):
+        self.update_kernel_drops()
+        now = time.time()
+        t_last, packets_last, bytes_last, photons_last = self.last_snapshot
+        dt = max(now - t_last, 1e-9)
+        self.last_snapshot = (now, self.packets, self.bytes, self.photons)
+
+        return {
+            'time': now,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'photons': self.photons,
+            'packets_per_s': (self.packets - packets_last) / dt,
+            'bytes_per_s': (self.bytes - bytes_last) / dt,
+            'photons_per_s': (self.photons - photons_last) / dt,
+            'unknown_src': self.unknown_src,
+            'misaligned': self.misaligned,
+            'truncated': self.truncated,
+            'queue_drops': self.queue_drops,
+            'kernel_drops': self.kernel_drops,
+            'filtered': self.filtered,
+            'sources': {src: {'packets': t.packets,
+                              'lost': t.lost,
+                              'reordered': t.reordered,
+                              'duplicates': t.duplicates,
+                              'resets': t.resets}
+                        for src, t in self.trackers.items()},
+        }
+
+    def format_snapshot(self, snap):
+        line = (f'{snap["packets_per_s"]:.0f} pkt/s, '
+                f'{snap["photons_per_s"]:.0f} photons/s, '
+                f'{snap["bytes_per_s"] / 1e6:.2f} MB/s | '
+                f'misaligned={snap["misaligned"]} truncated={snap["truncated"]} '
+                f'unknown_src={snap["unknown_src"]} queue_drops={snap["queue_drops"]} '
+                f'kernel_drops={snap["kernel_drops"]} filtered={snap["filtered"]}')
+        for src, s in snap['sources'].items():
+            line += (f' | {src}: lost={s["lost"]} reordered={s["reordered"]} '
+                     f'dup={s["duplicates"]} resets={s["resets"]}')
+        return line
@@ -1,7 +1,6 @@
 #!/home/idg/src/zodPlot/venv/bin/python
 import os
 import sys
-import subprocess
 from frame_buffer import Framebuffer
 
 fb0 = Framebuffer()
@@ -10,7 +9,8 @@ fb0.clear_screen()
 filename = sys.argv[1]
 
 if os.path.isfile(filename):
-    subprocess.run(["cp", filename, "/dev/fb0"])
+    with open(filename, 'rb') as f:
+        fb0.write_bytes_to_fb(f.read())
     print('OK')
 else:
     print('BAD')
\ No newline at end of file
@@ -7,19 +7,25 @@
 ###############################################################################
 
 import sys, os
+import time
 import asyncio
 import netifaces
 import logging
 import argparse
 import shlex
 import numpy as np
-import pigpio as gpio
 
 from signal import SIGINT, SIGTERM
 from multiprocessing import Process, Queue, Event
 
 from data_rcvr import Plot2FrameBuffer
-from udp_server import AsyncUDPServer
+from udp_server import AsyncUDPServer, PHOTON_DTYPE
+from photon_ring import PhotonRing, PhotonRingSet
+from replay import PhotonReplayer
+from frame_buffer import STRETCHES
+from accumulator import EXPOSURES, DELTA_DTYPE, PhotonBinner, SourceTiles
+from display_backend import DISPLAY_ENV, get_geometry
+from overlay import image_area
 
 
 LOGGER_NAME = 'zod_plot'
@@ -37,7 +43,24 @@ TEST_1_IP = '192.168.1.123'
 TEST_2_IP = '172.16.0.171'
 TEST_3_IP = '172.16.1.112'
 
-async def runDAQ(q_mp, closing_event):
+TDC_DICT = {
+    "tdc_0_ip": TDC_0_IP,
+    "test_0_ip": TEST_0_IP,
+    "test_1_ip": TEST_1_IP,
+    "test_2_ip": TEST_2_IP,
+    "test_3_ip": TEST_3_IP,
+}
+IP_DICT = {ip: name for name, ip in TDC_DICT.items()}
+
+def get_binner(opts):
+    if not opts.prebin:
+        return None
+    tiles = None
+    if opts.split:
+        tiles = SourceTiles(*opts.screenSize, opts.split)
+    return PhotonBinner(*opts.screenSize, tiles=tiles)
+
+async def runDAQ(q_mp, closing_event, opts, worker=0):
     logger = logging.getLogger(LOGGER_NAME)
 
     try:
@@ -46,34 +69,47 @@ async def runDAQ(q_mp, closing_event):
         local_ip = '192.168.1.123'
     
     port = 60000
-    tdc_dict = {
-        "tdc_0_ip": TDC_0_IP,
-        "test_0_ip": TEST_0_IP,
-        "test_1_ip": TEST_1_IP,
-        "test_2_ip": TEST_2_IP,
-        "test_3_ip": TEST_3_IP,
-    }
-    ip_dict = {
-        TDC_0_IP: "tdc_0_ip",
-        TEST_0_IP: "test_0_ip",
-        TEST_1_IP: "test_1_ip",
-        TEST_2_IP: "test_2_ip",
-        TEST_3_IP: "test_3_ip",
-    }
+    tdc_dict = TDC_DICT
+    ip_dict = IP_DICT
 
     logger.info(f'ZPLOT IP = {local_ip}')
     logger.info(f'TDC_0 IP = {tdc_dict["tdc_0_ip"]}')
     logger.info(f'PORT = {port}')
 
-    udp_server = AsyncUDPServer(logger.getChild('udp_server'),
+    server_name = 'udp_server'
+    if opts.ingestWorkers > 1:
+        server_name = f'udp_server_{worker}'
+
+    record_path = None
+    if opts.recordPhotons:
+        record_dir = opts.imgLog if opts.recordDir is None else opts.recordDir
+        record_path = f'{record_dir}{time.strftime("%Y%m%d_%H%M%S")}'
+        if opts.ingestWorkers > 1:
+            record_path += f'_w{worker}'
+        record_path += '.zph'
+
+    udp_server = AsyncUDPServer(logger.getChild(server_name),
                                 '', 
                                 port,
                                 q_mp,
                                 closing_event, 
                                 tdc_dict, 
-                                ip_dict)
+                                ip_dict,
+                                stats_interval=opts.statsInterval,
+                                ingest=opts.ingest,
+                                rcv_buf=opts.rcvBuf,
+                                recv_batch=opts.recvBatch,
+                                busy_poll=opts.busyPoll,
+                                batch_packets=opts.batchPackets,
+                                batch_time=opts.batchTime,
+                                record_path=record_path,
+                                pcap_path=opts.pcap,
+                                binner=get_binner(opts),
+                                kernel_filter=not opts.noKernelFilter,
+                                workers=opts.ingestWorkers)
     
     await asyncio.gather(udp_server.start_server()) 
+    return udp_server
     
 async def run_framebuffer_display(q_mp, closing_event, opts):
     logger = logging.getLogger(LOGGER_NAME)
@@ -81,7 +117,7 @@ async def run_framebuffer_display(q_mp, closing_event, opts):
     plot2FB = Plot2FrameBuffer(logger.getChild('fb_display'), 
                                q_mp, 
                                closing_event, 
-                               GPIO_MAP,
+                               None if opts.noGPIO else GPIO_MAP,
                                opts,)
     
     await asyncio.gather(plot2FB.start_get_q_mp_data(), 
@@ -103,18 +139,49 @@ def start_receiver(q_mp, closing_event, opts):
         loop.close()
         asyncio.set_event_loop(None)
 
-def start_sender(q_mp, closing_event):
+def start_sender(q_mp, closing_event, opts, worker=0):
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
     for signal_enum in [SIGINT, SIGTERM]:
         loop.add_signal_handler(signal_enum, loop.stop)
 
+    udp_server = None
     try:
-        loop.run_until_complete(runDAQ(q_mp, closing_event))
+        udp_server = loop.run_until_complete(runDAQ(q_mp, closing_event, opts, worker))
         loop.run_forever()
     except RuntimeError as exc:
         print(exc)
+    finally:
+        if udp_server is not None:
+            udp_server.close()
+        loop.close()
+        asyncio.set_event_loop(None)
+
+async def run_replay(q_mp, closing_event, opts):
+    logger = logging.getLogger(LOGGER_NAME)
+
+    replayer = PhotonReplayer(logger.getChild('replay'),
+                              opts.replay,
+                              q_mp,
+                              closing_event,
+                              speed=opts.replaySpeed,
+                              batch_time=opts.batchTime,
+                              binner=get_binner(opts))
+
+    await replayer.start_replay()
+
+def start_replayer(q_mp, closing_event, opts):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    for signal_enum in [SIGINT, SIGTERM]:
+        loop.add_signal_handler(signal_enum, loop.stop)
+
+    try:
+        loop.run_until_complete(run_replay(q_mp, closing_event, opts))
+    except RuntimeError as exc:
+        print(exc)
     finally:
         loop.close()
         asyncio.set_event_loop(None)
@@ -133,10 +200,91 @@ def argparser(argv):
     parser.add_argument('--gain', type=int, default=1,
                         help='gain to increase photon brightness per pixel. \
                             A value of 18718 would use the original photon value.')
-    parser.add_argument('--imgLog', type=str, default=f'/home/{os.getlogin()}/imgs/',
+    parser.add_argument('--display', type=str, default=os.environ.get(DISPLAY_ENV, 'fbdev'),
+                        help='display backend: fbdev[:<device>] or \
+                            offscreen[:<W>x<H>x<bpp>[:<file>]] for headless runs')
+    parser.add_argument('--stretch', type=str, default='linear', choices=STRETCHES,
+                        help='tone curve applied after the gain')
+    parser.add_argument('--zoomLevels', type=int, default=1,
+                        help='zoom levels kept (1x, 2x, 4x, ...). Every photon is added to each \
+                            level and each level has 4x the memory of the last, 1=no zoom')
+    parser.add_argument('--zoom', type=int, default=0,
+                        help='initial zoom level (2^zoom, centred)')
+    parser.add_argument('--split', type=str, default=None,
+                        help='split screen, one tile per source: "all" or a comma-separated \
+                            list of tdc_dict names. Disables zoom.')
+    parser.add_argument('--overlay', action='store_true',
+                        help='reserve a strip at the bottom of the screen for the live \
+                            pulse-height histogram and count-rate chart')
+    parser.add_argument('--overlayHeight', type=int, default=64,
+                        help='height of the overlay strip (px)')
+    parser.add_argument('--rateInterval', type=float, default=1,
+                        help='seconds per count-rate chart column')
+    parser.add_argument('--exposure', type=str, default='infinite', choices=EXPOSURES,
+                        help='infinite=accumulate until CLEAR, rolling=last --exposureTime s, \
+                            decay=fade with time constant --exposureTime. Hold CLEAR to cycle.')
+    parser.add_argument('--exposureTime', type=float, default=10,
+                        help='rolling window length / decay time constant (s)')
+    parser.add_argument('--exposureSteps', type=int, default=10,
+                        help='sub-frames per rolling window / decay steps per time constant. \
+                            rolling keeps this many copies of the screen (zoom is off while rolling)')
+    parser.add_argument('--imgLog', type=str, default=os.path.expanduser('~/imgs/'),
                         help='path to the screenshots')
+    parser.add_argument('--noGPIO', action='store_true',
+                        help='run the display without buttons/encoder (fixed --gain)')
+    parser.add_argument('--ingest', type=str, default='protocol', choices=['protocol', 'batched'],
+                        help='UDP ingest. protocol=asyncio DatagramProtocol, \
+                            batched=drain all ready datagrams per wake-up (recvmmsg)')
+    parser.add_argument('--rcvBuf', type=int, default=0,
+                        help='socket SO_RCVBUF in bytes (0=kernel default)')
+    parser.add_argument('--recvBatch', type=int, default=64,
+                        help='datagrams per recvmmsg call (batched ingest)')
+    parser.add_argument('--busyPoll', type=int, default=0,
+                        help='us to keep polling the socket after it runs dry (batched ingest)')
+    parser.add_argument('--noKernelFilter', action='store_true',
+                        help='don\'t attach the BPF source filter, check sources in Python only')
+    parser.add_argument('--ingestWorkers', type=int, default=1,
+                        help='UDP ingest processes sharing the port (SO_REUSEPORT), \
+                            each TDC source handled by one of them')
+    parser.add_argument('--batchPackets', type=int, default=1,
+                        help='packets coalesced into one message to the display process')
+    parser.add_argument('--batchTime', type=int, default=2000,
+                        help='max us a partial batch is held before it is sent')
+    parser.add_argument('--statsInterval', type=float, default=10,
+                        help='seconds between ingest / display stats log lines (0=off)')
+    parser.add_argument('--maxBatch', type=int, default=64,
+                        help='max packets/batches the display drains per wake-up')
+    parser.add_argument('--transport', type=str, default='queue', choices=['queue', 'shm'],
+                        help='sender -> receiver channel. queue=multiprocessing.Queue, \
+                            shm=shared-memory photon ring buffer')
+    parser.add_argument('--ringSize', type=int, default=2**20,
+                        help='shm ring buffer capacity (photons)')
+    parser.add_argument('--ringBatches', type=int, default=4096,
+                        help='shm ring buffer capacity (packets/batches)')
+    parser.add_argument('--recordPhotons', action='store_true',
+                        help='record every accepted photon to a .zph file')
+    parser.add_argument('--recordDir', type=str, default=None,
+                        help='directory for photon recordings (default: --imgLog)')
+    parser.add_argument('--pcap', type=str, default=None,
+                        help='feed TDC datagrams from a pcap/pcapng capture instead of the socket')
+    parser.add_argument('--prebin', action='store_true',
+                        help='sender bins photons into sparse screen-pixel deltas before \
+                            sending them to the display process. Disables zoom.')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='replay a recorded .zph photon file instead of listening for UDP')
+    parser.add_argument('--replaySpeed', type=float, default=1,
+                        help='replay speed: 1=real time, N=N times faster, 0=unthrottled')
+    parser.set_defaults(sources=list(TDC_DICT))
     opts = parser.parse_args(argv)
 
+    if opts.split is not None:
+        # Source names -> indexes into tdc_dict (the photons' pad byte)
+        names = opts.sources if opts.split == 'all' else opts.split.split(',')
+        unknown = [name for name in names if name not in opts.sources]
+        if unknown:
+            parser.error(f'--split: unknown sources {unknown}, expected {opts.sources}')
+        opts.split = [opts.sources.index(name) for name in names]
+
     return opts
 
 def main(argv=None):
@@ -161,23 +309,60 @@ def main(argv=None):
     closing_event = Event()  # Event to signal closing of the receiver to the other process
     reset_event = Event()  # Event to signal the press of the reset button
 
-    q_mp = Queue(maxsize=0)
+    if opts.prebin:
+        # The sender bins to screen pixels, so it needs the display geometry
+        width, height = get_geometry(opts.display)
+        x0, width, height = image_area(width, height, opts.overlayHeight if opts.overlay else 0)
+        opts.screenSize = (width, height)
+        opts.zoomLevels = 1
+    if opts.split:
+        opts.zoomLevels = 1
+
+    if opts.replay is not None or opts.pcap is not None:
+        # One file, one reader
+        opts.ingestWorkers = 1
+
+    if opts.transport == 'shm':
+        dtype = DELTA_DTYPE if opts.prebin else PHOTON_DTYPE
+        if opts.ingestWorkers > 1:
+            # One single-producer ring per worker, merged by the receiver
+            q_mp = PhotonRingSet(opts.ingestWorkers, opts.ringSize, opts.ringBatches, dtype)
+            channels = q_mp.rings
+        else:
+            q_mp = PhotonRing(capacity=opts.ringSize, max_batches=opts.ringBatches, dtype=dtype)
+            channels = [q_mp]
+    else:
+        # multiprocessing.Queue takes any number of producers
+        q_mp = Queue(maxsize=0)
+        channels = [q_mp] * opts.ingestWorkers
 
     receiver = Process(target=start_receiver, args=(q_mp, closing_event, opts))
-    sender = Process(target=start_sender, args=(q_mp, closing_event))
+    if opts.replay is not None:
+        senders = [Process(target=start_replayer, args=(q_mp, closing_event, opts))]
+    else:
+        senders = [Process(target=start_sender, args=(channel, closing_event, opts, worker))
+                   for worker, channel in enumerate(channels)]
     # interrupter = Process(target=start_interrupter, args=(closing_event, reset_event))
     
     receiver.start()
-    sender.start()
+    for sender in senders:
+        sender.start()
     # interrupter.start()
 
     try:
         receiver.join()
-        sender.join()
+        for sender in senders:
+            sender.join()
         # interrupter.join()
     except KeyboardInterrupt:
         closing_event.set()
         logger.info('~~~~~~ stopping zodPlot main process ~~~~~~')
+    finally:
+        if isinstance(q_mp, (PhotonRing, PhotonRingSet)):
+            logger.info(f'ring overflow: {q_mp.overflow_batches} batches, '
+                        f'{q_mp.overflow_records} photons')
+            q_mp.close()
+            q_mp.unlink()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,175 @@
+# overlay.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Stats strip along the bottom of the screen: pulse-height (P) histogram on
+# the left, count-rate sweep chart on the right. Axes are rasterised once;
+# each frame only the bars / chart columns that changed are redrawn.
+###############################################################################
+
+import time
+import numpy as np
+
+PHA_BINS = 256  # P is 8 bits
+PANEL_GAP = 8  # px between the two panels
+AXIS_GREY = 96
+TICK_GREY = 160
+BAR_GREY = 255
+CURSOR_GREY = 48  # erased column just ahead of the sweep
+PHA_TICKS = (0, 64, 128, 192, 255)
+MIN_RATE_SCALE = 1024  # photons/s, full height of the rate chart at start
+
+def image_area(width, height, strip_height=0):
+    # Where the image goes once the strip is reserved: (x0, width, height).
+    # The image stays square (the detector is), centred above the strip.
+    if strip_height <= 0:
+        return 0, width, height
+
+    side = min(width, height - strip_height)
+    return (width - side) // 2, side, side
+
+class StatsOverlay():
+    def __init__(self, view, bits_pp, rate_interval=1.0, logger=None):
+        # view: the strip of the display, (h, w) uint32 pixels at 32 bpp,
+        # (h, w, bytes_pp) uint8 otherwise
+        self.view = view
+        self.bits_pp = bits_pp
+        self.logger = logger
+        self.height = view.shape[0]
+        self.width = view.shape[1]
+        self.plot_h = self.height - 3  # rows above the axis and tick marks
+
+        # Left panel: PHA bars, 2^k channels per bar so they fit
+        pha_w = (self.width - PANEL_GAP) // 2
+        self.pha_group = 1
+        while PHA_BINS // self.pha_group > pha_w - 1:
+            self.pha_group *= 2
+        self.pha_bar_w = (pha_w - 1) // (PHA_BINS // self.pha_group)
+        self.pha_x0 = 1  # right of the y axis
+        self.pha_counts = np.zeros(PHA_BINS, dtype=np.int64)
+        self.pha_heights = np.zeros(PHA_BINS // self.pha_group, dtype=np.intp)
+
+        # Right panel: sweep chart, one column per rate_interval s, written
+        # at a cursor that wraps instead of scrolling the whole chart
+        self.rate_x0 = pha_w + PANEL_GAP + 1
+        self.rate_w = self.width - self.rate_x0
+        self.rates = np.zeros(self.rate_w, dtype=np.float64)
+        self.rate_heights = np.zeros(self.rate_w, dtype=np.intp)
+        self.rate_scale = MIN_RATE_SCALE
+        self.rate_interval = rate_interval
+        self.cursor = 0
+        self.photons = 0
+        self.next_sample = time.time() + rate_interval
+        self.last_sample = time.time()
+
+        self.background = self.rasterise_axes(pha_w)
+        self.rows = np.arange(self.plot_h)[:, np.newaxis]
+        self.full_redraw = True
+
+    def rasterise_axes(self, pha_w):
+        bg = np.zeros((self.height, self.width), dtype=np.uint8)
+        axis = self.plot_h
+        for x0, w in ((0, pha_w), (self.rate_x0 - 1, self.rate_w + 1)):
+            bg[:axis+1, x0] = AXIS_GREY
+            bg[axis, x0:x0+w] = AXIS_GREY
+
+        # P channel ticks under the histogram
+        for p in PHA_TICKS:
+            x = self.pha_x0 + (p // self.pha_group) * self.pha_bar_w
+            bg[axis+1:, min(x, pha_w - 1)] = TICK_GREY
+
+        # Half-scale marks on the rate axis
+        bg[self.plot_h // 2, self.rate_x0 - 3:self.rate_x0 - 1] = TICK_GREY
+        return bg
+
+    def add(self, num_photons, ps=None):
+        # Accumulation side: ps is None for pre-binned batches (no P)
+        self.photons += num_photons
+        if ps is not None:
+            self.pha_counts += np.bincount(ps, minlength=PHA_BINS)
+
+    def clear(self):
+        self.pha_counts[:] = 0
+
+    def sample(self, now):
+        # One rate point per rate_interval s, under the display lock
+        if now < self.next_sample:
+            return False
+
+        self.rates[self.cursor] = self.photons / max(now - self.last_sample, 1e-9)
+        self.photons = 0
+        self.last_sample = now
+        self.cursor = (self.cursor + 1) % self.rate_w
+        self.next_sample += self.rate_interval
+        if self.next_sample < now:
+            self.next_sample = now + self.rate_interval
+        return True
+
+    def to_pixels(self, grey):
+        if self.bits_pp == 32:
+            px = grey.astype(np.uint32)
+            return px | (px << 8) | (px << 16)
+        return grey[:, :, np.newaxis]
+
+    def draw_columns(self, x, heights, cursor=None):
+        # Background column with a bar from the axis up to `heights`
+        cols = self.background[:, x].copy()
+        bars = self.rows >= (self.plot_h - heights)[np.newaxis, :]
+        cols[:self.plot_h][bars] = BAR_GREY
+        if cursor is not None:
+            cols[:self.plot_h, cursor] = CURSOR_GREY
+
+        if self.bits_pp == 32:
+            self.view[:, x] = self.to_pixels(cols)
+        else:
+            self.view[:, x, :3] = self.to_pixels(cols)
+
+    def draw(self, pha_counts, sampled):
+        # Render thread. pha_counts is a copy taken, and sample() run, under
+        # the display lock; sampled says whether a new rate point was taken.
+        if self.full_redraw:
+            if self.bits_pp == 32:
+                self.view[:] = self.to_pixels(self.background)
+            else:
+                self.view[:, :, :3] = self.to_pixels(self.background)
+
+        # PHA: linear, full height = the fullest bar
+        grouped = pha_counts.reshape(-1, self.pha_group).sum(axis=1)
+        peak = grouped.max()
+        heights = np.zeros(len(grouped), dtype=np.intp)
+        if peak > 0:
+            heights = (grouped * self.plot_h // peak).astype(np.intp)
+        changed = np.flatnonzero(heights != self.pha_heights) if not self.full_redraw \
+            else np.arange(len(heights))
+        if len(changed):
+            self.pha_heights = heights
+            x = (self.pha_x0 + changed[:, np.newaxis] * self.pha_bar_w
+                 + np.arange(self.pha_bar_w)[np.newaxis, :]).reshape(-1)
+            self.draw_columns(x, np.repeat(heights[changed], self.pha_bar_w))
+
+        # Rate: the scale doubles (whole chart redrawn) when a point tops it
+        redraw_rate = self.full_redraw
+        if sampled:
+            written = (self.cursor - 1) % self.rate_w
+            if self.rates[written] > self.rate_scale:
+                while self.rates[written] > self.rate_scale:
+                    self.rate_scale *= 2
+                redraw_rate = True
+                if self.logger is not None:
+                    self.logger.info(f'rate chart full scale: {self.rate_scale} photons/s')
+
+            heights = np.minimum(self.rates * self.plot_h / self.rate_scale,
+                                 self.plot_h).astype(np.intp)
+            if redraw_rate:
+                columns = np.arange(self.rate_w)
+            else:
+                columns = np.array([written, self.cursor])
+            self.rate_heights = heights
+            self.draw_columns(self.rate_x0 + columns, heights[columns],
+                              cursor=np.flatnonzero(columns == self.cursor))
+        elif redraw_rate:
+            columns = np.arange(self.rate_w)
+            self.draw_columns(self.rate_x0 + columns, self.rate_heights[columns],
+                              cursor=np.flatnonzero(columns == self.cursor))
+
+        self.full_redraw = False
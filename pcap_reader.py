@@ -0,0 +1,270 @@
+# pcap_reader.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Feeds TDC datagrams from a tcpdump capture (pcap or pcapng) through the
+# udp_server protocol's parser, streaming the file record by record.
+# IPv4/UDP only; Ethernet (incl. VLAN), Linux cooked (SLL/SLL2), BSD
+# loopback and raw IP link layers.
+###############################################################################
+
+import time
+import socket
+import struct
+import asyncio
+
+from photon_ring import wait_for_room
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BOM = 0x1a2b3c4d
+PCAPNG_IDB = 1
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+PCAPNG_OPT_TSRESOL = 9
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+IPPROTO_UDP = 17
+
+READ_BUFFER = 1024 * 1024
+YIELD_EVERY = 256  # datagrams fed between event loop yields
+
+def iter_pcap(f):
+    # Yields (timestamp, link_type, frame) for every captured packet
+    magic = f.read(4)
+    if len(magic) < 4:
+        return
+
+    if struct.unpack('<I', magic)[0] == PCAPNG_SHB:
+        yield from iter_pcapng(f, magic)
+        return
+
+    for endian in '<>':
+        magic_num = struct.unpack(endian + 'I', magic)[0]
+        if magic_num in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            break
+    else:
+        raise ValueError('not a pcap/pcapng file')
+
+    ts_scale = 1e-9 if magic_num == PCAP_MAGIC_NS else 1e-6
+    hdr = f.read(20)
+    link_type = struct.unpack(endian + 'I', hdr[16:20])[0] & 0xFFFF
+    rec_hdr = struct.Struct(endian + 'IIII')
+
+    while True:
+        rec = f.read(16)
+        if len(rec) < 16:
+            return
+        ts_sec, ts_frac, incl_len, orig_len = rec_hdr.unpack(rec)
+        frame = f.read(incl_len)
+        if len(frame) < incl_len:
+            return
+        yield ts_sec + ts_frac * ts_scale, link_type, frame
+
+def iter_pcapng(f, block_type):
+    endian = '<'
+    interfaces = []
+
+    while True:
+        if block_type is None:
+            block_type = f.read(4)
+        head = f.read(4)
+        if len(block_type) < 4 or len(head) < 4:
+            return
+
+        if struct.unpack('<I', block_type)[0] == PCAPNG_SHB:
+            # Section header: the byte-order magic decides the endianness
+            bom = f.read(4)
+            endian = '<' if struct.unpack('<I', bom)[0] == PCAPNG_BOM else '>'
+            block_len = struct.unpack(endian + 'I', head)[0]
+            f.read(block_len - 12)
+            interfaces = []
+            block_type = None
+            continue
+
+        btype = struct.unpack(endian + 'I', block_type)[0]
+        block_len = struct.unpack(endian + 'I', head)[0]
+        body = f.read(block_len - 8)
+        block_type = None
+        if len(body) < block_len - 8:
+            return
+        body = body[:-4]  # trailing block length
+
+        if btype == PCAPNG_IDB:
+            link_type = struct.unpack(endian + 'H', body[:2])[0]
+            interfaces.append((link_type, read_tsresol(body[8:], endian)))
+
+        elif btype == PCAPNG_EPB:
+            if_id, ts_hi, ts_lo, cap_len = struct.unpack(endian + 'IIII', body[:16])
+            link_type, ts_scale = interfaces[if_id]
+            yield ((ts_hi << 32) | ts_lo) * ts_scale, link_type, body[20:20+cap_len]
+
+        elif btype == PCAPNG_SPB and interfaces:
+            link_type, ts_scale = interfaces[0]
+            orig_len = struct.unpack(endian + 'I', body[:4])[0]
+            yield None, link_type, body[4:4+orig_len]
+
+def read_tsresol(options, endian):
+    # if_tsresol: 10^-n (or 2^-n with the top bit set) seconds, default 10^-6
+    pos = 0
+    while pos + 4 <= len(options):
+        code, length = struct.unpack(endian + 'HH', options[pos:pos+4])
+        if code == 0:
+            break
+        if code == PCAPNG_OPT_TSRESOL and length >= 1:
+            res = options[pos+4]
+            return 2.0 ** -(res & 0x7F) if res & 0x80 else 10.0 ** -res
+        pos += 4 + length + (-length % 4)
+    return 1e-6
+
+def decode_udp(link_type, frame):
+    # (src_ip, src_port, dst_port, payload) for an unfragmented IPv4/UDP frame
+    frame = memoryview(frame)
+    ethertype = ETHERTYPE_IPV4
+    if link_type == LINKTYPE_ETHERNET:
+        if len(frame) < 14:
+            return None
+        ethertype = (frame[12] << 8) | frame[13]
+        off = 14
+        while ethertype in ETHERTYPE_VLAN and len(frame) >= off + 4:
+            ethertype = (frame[off+2] << 8) | frame[off+3]
+            off += 4
+    elif link_type == LINKTYPE_LINUX_SLL:
+        if len(frame) < 16:
+            return None
+        ethertype = (frame[14] << 8) | frame[15]
+        off = 16
+    elif link_type == LINKTYPE_LINUX_SLL2:
+        if len(frame) < 20:
+            return None
+        ethertype = (frame[0] << 8) | frame[1]
+        off = 20
+    elif link_type == LINKTYPE_NULL:
+        # AF_INET in host byte order of the capturing machine
+        if len(frame) < 4 or socket.AF_INET not in (frame[0], frame[3]):
+            return None
+        off = 4
+    elif link_type in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        off = 0
+    else:
+        return None
+
+    if ethertype != ETHERTYPE_IPV4:
+        return None
+
+    ip = frame[off:]
+    if len(ip) < 20 or ip[0] >> 4 != 4 or ip[9] != IPPROTO_UDP:
+        return None
+    if ((ip[6] << 8) | ip[7]) & 0x3FFF:
+        return None  # fragment (MF set or non-zero offset)
+
+    ihl = (ip[0] & 0x0F) * 4
+    total_len = (ip[2] << 8) | ip[3]
+    udp = ip[ihl:total_len]
+    if len(udp) < 8:
+        return None
+
+    src_port = (udp[0] << 8) | udp[1]
+    dst_port = (udp[2] << 8) | udp[3]
+    udp_len = (udp[4] << 8) | udp[5]
+
+    return socket.inet_ntoa(ip[12:16]), src_port, dst_port, bytes(udp[8:udp_len])
+
+class PcapReader():
+    def __init__(self, logger, loop, path, protocol, port=60000):
+        self.logger = logger
+        self.loop = loop
+        self.path = path
+        self.protocol = protocol
+        self.port = port
+
+        self.closing = False
+        self.task = None
+
+        self.frames = 0
+        self.not_udp = 0
+        self.other_port = 0
+        self.fed = 0
+
+    # transport-like interface for the protocol (log_stats, benchmark)
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            if self.task is not None:
+                self.task.cancel()
+            self.protocol.connection_lost(None)
+
+    def start(self):
+        self.protocol.connection_made(self)
+        self.task = self.loop.create_task(self.feed())
+
+    async def feed(self):
+        self.logger.info(f'reading {self.path}')
+        t_start = time.time()
+
+        with open(self.path, 'rb', buffering=READ_BUFFER) as f:
+            for ts, link_type, frame in iter_pcap(f):
+                if self.closing:
+                    return
+                self.frames += 1
+
+                udp = decode_udp(link_type, frame)
+                if udp is None:
+                    self.not_udp += 1
+                    continue
+                src_ip, src_port, dst_port, payload = udp
+                if dst_port != self.port:
+                    self.other_port += 1
+                    continue
+                if src_ip not in self.protocol.ip_dict:
+                    self.protocol.stats.unknown_src += 1
+                    continue
+
+                await self.wait_for_room(payload)
+                # Stamped on ingest like live traffic, capture time is not used
+                self.protocol.parse_datagram((time.time(), (src_ip, src_port), payload))
+                self.fed += 1
+
+                if self.fed % YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+
+        await self.wait_for_room(b'')
+        self.protocol.flush_batch()
+        elapsed = max(time.time() - t_start, 1e-9)
+        self.logger.info(f'pcap done: {self.frames} frames, {self.fed} datagrams fed '
+                         f'({self.not_udp} not IPv4/UDP, {self.other_port} other ports) '
+                         f'in {elapsed:.2f} s | {self.protocol.stats.format_snapshot(self.protocol.stats.snapshot())}')
+
+    def batch_size(self, payload):
+        # Photons the protocol may flush after this datagram: its pending
+        # batch plus the datagram (pre-binned deltas are never more)
+        num_photons = payload[0] | (payload[1] << 8) if len(payload) >= 2 else 0
+        return sum(len(photons) for photons in self.protocol.batch) + num_photons
+
+    async def wait_for_room(self, payload):
+        # Back-pressure instead of dropping, so every run sees the same photons
+        q_fifo = self.protocol.q_fifo
+        num_rec = self.batch_size(payload)
+        capacity = getattr(q_fifo, 'capacity', None)
+        if capacity is not None and num_rec > capacity:
+            # Would never fit: send the pending batch on its own first
+            await self.wait_for_room(b'')
+            self.protocol.flush_batch()
+            num_rec = min(self.batch_size(payload), capacity)
+
+        await wait_for_room(q_fifo, num_rec, self.is_closing)
@@ -0,0 +1,261 @@
+# photon_file.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Raw photon event files (.zph): append-only, chunked, little-endian.
+#
+#   file header   b'ZODPHOT1', version u4, json length u4, json (8B padded)
+#   chunk         CHUNK_HDR_DTYPE, then num_records RECORD_DTYPE records
+#   ...
+#   index         INDEX_DTYPE per chunk         (written on close)
+#   trailer       b'ZIDX', chunk count u4, index offset u8
+#
+# Every chunk header carries its time range, so a file that was never
+# closed (power cut) can still be indexed by walking the chunks.
+###############################################################################
+
+import json
+import mmap
+import queue
+import threading
+import numpy as np
+
+FILE_MAGIC = b'ZODPHOT1'
+FILE_VERSION = 1
+CHUNK_MAGIC = b'ZCHK'
+INDEX_MAGIC = b'ZIDX'
+
+RECORD_DTYPE = np.dtype([('x', '<u2'), ('y', '<u2'), ('p', 'u1'), ('src', 'u1'),
+                         ('pkt_count', '<u2'), ('rcv_time', '<f8')])
+CHUNK_HDR_DTYPE = np.dtype([('magic', 'S4'), ('num_records', '<u4'),
+                            ('t_first', '<f8'), ('t_last', '<f8'),
+                            ('prev_offset', '<u8')])
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('num_records', '<u8'),
+                        ('t_first', '<f8'), ('t_last', '<f8')])
+TRAILER_DTYPE = np.dtype([('magic', 'S4'), ('num_chunks', '<u4'), ('index_offset', '<u8')])
+
+CHUNK_RECORDS = 2 ** 16  # 1 MiB of records per chunk
+CHUNK_FLUSH_TIME = 1.0  # s, a partial chunk is written out after this long idle
+WRITE_BUFFER = 4 * 1024 * 1024
+CLOSE_TIMEOUT = 0.5  # s between checks that the writer is still alive
+
+class PhotonRecorder():
+    # Streams photons to a .zph file from a background writer thread.
+    # record() never blocks: if the writer falls behind, photons are counted
+    # as dropped instead of stalling ingest.
+    def __init__(self, path, sources, logger=None, queue_size=4096,
+                 chunk_records=CHUNK_RECORDS):
+        self.path = path
+        self.sources = list(sources)
+        self.logger = logger
+
+        self.q = queue.Queue(maxsize=queue_size)
+        self.chunk = np.zeros(chunk_records, dtype=RECORD_DTYPE)
+        self.fill = 0
+        self.prev_offset = 0
+        self.index = []
+
+        self.num_recorded = 0
+        self.num_dropped = 0
+        self.failed = False  # set by the writer thread if the file can't be written
+
+        self.thread = threading.Thread(target=self.run, name='photon_recorder', daemon=True)
+        self.thread.start()
+
+        if self.logger is not None:
+            self.logger.info(f'recording photons to {self.path}')
+
+    def record(self, rcv_time, src, pkt_count, photons):
+        if self.failed:
+            self.num_dropped += len(photons)
+            return
+        try:
+            self.q.put_nowait((rcv_time, src, pkt_count, photons))
+        except queue.Full:
+            self.num_dropped += len(photons)
+
+    def close(self):
+        # A failed writer no longer drains the queue, don't wait on it
+        while self.thread.is_alive():
+            try:
+                self.q.put(None, timeout=CLOSE_TIMEOUT)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        if self.logger is not None:
+            self.logger.info(f'recorded {self.num_recorded} photons '
+                             f'({self.num_dropped} dropped) to {self.path}')
+
+    def run(self):
+        try:
+            self.write_file()
+        except OSError as e:
+            self.failed = True
+            if self.logger is not None:
+                self.logger.error(f'recording to {self.path} failed, photons are no longer recorded: {e}')
+            self.drop_queued()
+
+    def drop_queued(self):
+        while True:
+            try:
+                item = self.q.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self.num_dropped += len(item[3])
+
+    def write_file(self):
+        with open(self.path, 'wb', buffering=WRITE_BUFFER) as f:
+            self.write_file_header(f)
+            while True:
+                try:
+                    item = self.q.get(timeout=CHUNK_FLUSH_TIME)
+                except queue.Empty:
+                    self.write_chunk(f)
+                    continue
+
+                if item is None:
+                    break
+                self.add_records(f, *item)
+
+            self.write_chunk(f)
+            self.write_index(f)
+
+    def write_file_header(self, f):
+        meta = json.dumps({'sources': self.sources,
+                           'record_dtype': RECORD_DTYPE.descr}).encode()
+        meta += b' ' * (-len(meta) % 8)
+        f.write(FILE_MAGIC)
+        f.write(np.array([FILE_VERSION, len(meta)], dtype='<u4').tobytes())
+        f.write(meta)
+
+    def add_records(self, f, rcv_time, src, pkt_count, photons):
+        pos = 0
+        while pos < len(photons):
+            num = min(len(photons) - pos, len(self.chunk) - self.fill)
+            rec = self.chunk[self.fill:self.fill+num]
+            seg = photons[pos:pos+num]
+            rec['x'] = seg['x']
+            rec['y'] = seg['y']
+            rec['p'] = seg['p']
+            rec['src'] = src
+            rec['pkt_count'] = pkt_count
+            rec['rcv_time'] = rcv_time
+
+            self.fill += num
+            pos += num
+            if self.fill == len(self.chunk):
+                self.write_chunk(f)
+
+    def write_chunk(self, f):
+        if self.fill == 0:
+            return
+
+        records = self.chunk[:self.fill]
+        offset = f.tell()
+
+        hdr = np.zeros(1, dtype=CHUNK_HDR_DTYPE)
+        hdr['magic'] = CHUNK_MAGIC
+        hdr['num_records'] = self.fill
+        hdr['t_first'] = records['rcv_time'][0]
+        hdr['t_last'] = records['rcv_time'][-1]
+        hdr['prev_offset'] = self.prev_offset
+
+        f.write(hdr.tobytes())
+        f.write(records.tobytes())
+
+        self.index.append((offset, self.fill, hdr['t_first'][0], hdr['t_last'][0]))
+        self.prev_offset = offset
+        self.num_recorded += self.fill
+        self.fill = 0
+
+    def write_index(self, f):
+        index_offset = f.tell()
+        f.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+
+        trailer = np.zeros(1, dtype=TRAILER_DTYPE)
+        trailer['magic'] = INDEX_MAGIC
+        trailer['num_chunks'] = len(self.index)
+        trailer['index_offset'] = index_offset
+        f.write(trailer.tobytes())
+
+class PhotonFileReader():
+    # Memory-maps a .zph file; chunks come back as RECORD_DTYPE views
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:8] != FILE_MAGIC:
+            raise ValueError(f'{path} is not a photon file')
+
+        version, meta_len = np.frombuffer(self.mm, dtype='<u4', count=2, offset=8)
+        meta = json.loads(self.mm[16:16+meta_len])
+        self.sources = meta['sources']
+        self.data_offset = 16 + int(meta_len)
+
+        self.index = self.read_index()
+
+    def read_index(self):
+        size = len(self.mm)
+        if size >= self.data_offset + TRAILER_DTYPE.itemsize:
+            trailer = np.frombuffer(self.mm, dtype=TRAILER_DTYPE, count=1,
+                                    offset=size - TRAILER_DTYPE.itemsize)[0]
+            if trailer['magic'] == INDEX_MAGIC:
+                return np.frombuffer(self.mm, dtype=INDEX_DTYPE,
+                                     count=int(trailer['num_chunks']),
+                                     offset=int(trailer['index_offset']))
+
+        # No trailer (file not closed): walk the chunk headers
+        index = []
+        offset = self.data_offset
+        while offset + CHUNK_HDR_DTYPE.itemsize <= size:
+            hdr = np.frombuffer(self.mm, dtype=CHUNK_HDR_DTYPE, count=1, offset=offset)[0]
+            end = offset + CHUNK_HDR_DTYPE.itemsize + int(hdr['num_records']) * RECORD_DTYPE.itemsize
+            if hdr['magic'] != CHUNK_MAGIC or end > size:
+                break
+            index.append((offset, hdr['num_records'], hdr['t_first'], hdr['t_last']))
+            offset = end
+
+        return np.array(index, dtype=INDEX_DTYPE)
+
+    @property
+    def num_records(self):
+        return int(self.index['num_records'].sum())
+
+    @property
+    def time_range(self):
+        if len(self.index) == 0:
+            return None, None
+        return float(self.index['t_first'][0]), float(self.index['t_last'][-1])
+
+    def chunk(self, i):
+        entry = self.index[i]
+        return np.frombuffer(self.mm, dtype=RECORD_DTYPE,
+                             count=int(entry['num_records']),
+                             offset=int(entry['offset']) + CHUNK_HDR_DTYPE.itemsize)
+
+    def seek_time(self, t):
+        # First chunk that holds photons at or after t
+        return int(np.searchsorted(self.index['t_last'], t))
+
+    def iter_chunks(self, t_start=None, t_end=None):
+        first = 0 if t_start is None else self.seek_time(t_start)
+        for i in range(first, len(self.index)):
+            if t_end is not None and self.index['t_first'][i] > t_end:
+                break
+            records = self.chunk(i)
+            if t_start is not None and records['rcv_time'][0] < t_start:
+                records = records[np.searchsorted(records['rcv_time'], t_start):]
+            if t_end is not None and records['rcv_time'][-1] > t_end:
+                records = records[:np.searchsorted(records['rcv_time'], t_end, side='right')]
+            yield records
+
+    def close(self):
+        self.index = None
+        try:
+            self.mm.close()
+        except BufferError:
+            # Record views are still alive, the map is released with them
+            pass
@@ -0,0 +1,275 @@
+# photon_ring.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Single-producer/single-consumer ring buffer of fixed-width photon records
+# in shared memory. Drop-in replacement for the multiprocessing.Queue
+# between the udp_server (sender) and the display (receiver) processes:
+# put((rcv_time, photons)) / get() -> (marks, photons), no pickling. A get()
+# merges every pending batch; marks holds each one's end and rcv_time.
+###############################################################################
+
+import time
+import queue
+import asyncio
+import numpy as np
+from multiprocessing import Event, shared_memory
+
+# Header slots (uint64 counters, they only ever increase)
+HEAD = 0              # records written    (producer)
+TAIL = 1              # records read       (consumer)
+MARK_HEAD = 2         # batches written    (producer)
+MARK_TAIL = 3         # batches read       (consumer)
+OVERFLOW_BATCHES = 4  # batches dropped    (producer)
+OVERFLOW_RECORDS = 5  # records dropped    (producer)
+HEADER_SLOTS = 8
+
+# One mark per put(): where the batch ends and when it was received
+MARK_DTYPE = np.dtype([('end', '<u8'), ('rcv_time', '<f8')])
+
+MAX_PENDING = 256  # queued batches before a waiting producer backs off
+BACKOFF_TIME = 0.001  # s
+
+def has_room(q_fifo, num_rec):
+    # PhotonRing or multiprocessing.Queue, without counting an overflow
+    if hasattr(q_fifo, 'has_room'):
+        return q_fifo.has_room(num_rec)
+    return not q_fifo.full()
+
+async def wait_for_room(q_fifo, num_rec, is_closing, max_pending=MAX_PENDING):
+    # Back-pressure instead of dropping, for producers that must not lose
+    # photons (replay, pcap). False if is_closing() while waiting.
+    while (max_pending is not None and q_fifo.qsize() >= max_pending) \
+            or not has_room(q_fifo, num_rec):
+        if is_closing():
+            return False
+        await asyncio.sleep(BACKOFF_TIME)
+    return True
+
+
+class PhotonRing():
+    def __init__(self, capacity, max_batches, dtype, name=None, ready=None):
+        # dtype: udp_server.PHOTON_DTYPE or accumulator.DELTA_DTYPE (--prebin)
+        self.capacity = capacity
+        self.max_batches = max_batches
+        self.dtype = np.dtype(dtype)
+
+        hdr_bytes = HEADER_SLOTS * 8
+        mark_bytes = max_batches * MARK_DTYPE.itemsize
+        rec_bytes = capacity * self.dtype.itemsize
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=hdr_bytes + mark_bytes + rec_bytes)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+
+        self.header = np.ndarray((HEADER_SLOTS,), dtype=np.uint64,
+                                 buffer=self.shm.buf, offset=0)
+        self.marks = np.ndarray((max_batches,), dtype=MARK_DTYPE,
+                                buffer=self.shm.buf, offset=hdr_bytes)
+        self.records = np.ndarray((capacity,), dtype=self.dtype,
+                                  buffer=self.shm.buf, offset=hdr_bytes + mark_bytes)
+
+        if self.owner:
+            self.header[:] = 0
+
+        # Set by the producer after publishing, so the consumer can sleep
+        self.ready = Event() if ready is None else ready
+
+    def __getstate__(self):
+        # Re-attach by name when passed to a spawned process
+        return (self.shm.name, self.capacity, self.max_batches, self.dtype, self.ready)
+
+    def __setstate__(self, state):
+        name, capacity, max_batches, dtype, ready = state
+        self.__init__(capacity, max_batches, dtype, name=name, ready=ready)
+
+    @property
+    def overflow_batches(self):
+        return int(self.header[OVERFLOW_BATCHES])
+
+    @property
+    def overflow_records(self):
+        return int(self.header[OVERFLOW_RECORDS])
+
+    def qsize(self):
+        return int(self.header[MARK_HEAD] - self.header[MARK_TAIL])
+
+    def empty(self):
+        return self.header[MARK_HEAD] == self.header[MARK_TAIL]
+
+    def full(self):
+        return (self.header[HEAD] - self.header[TAIL]) >= self.capacity \
+            or self.qsize() >= self.max_batches
+
+    def has_room(self, num_rec):
+        # Whether a put() of num_rec records would fit right now. Unlike a
+        # failed put() this doesn't count as an overflow, so producers that
+        # wait instead of dropping (replay, pcap) can poll it.
+        free_rec = self.capacity - (int(self.header[HEAD]) - int(self.header[TAIL]))
+        free_marks = self.max_batches - (int(self.header[MARK_HEAD]) - int(self.header[MARK_TAIL]))
+        return num_rec <= free_rec and free_marks > 0
+
+    def put(self, item):
+        rcv_time, records = item
+        num_rec = len(records)
+        head = int(self.header[HEAD])
+        mark_head = int(self.header[MARK_HEAD])
+
+        free_rec = self.capacity - (head - int(self.header[TAIL]))
+        free_marks = self.max_batches - (mark_head - int(self.header[MARK_TAIL]))
+        if num_rec > free_rec or free_marks <= 0:
+            # Drop the whole batch, never block the producer
+            self.header[OVERFLOW_BATCHES] += 1
+            self.header[OVERFLOW_RECORDS] += num_rec
+            return False
+
+        idx = head % self.capacity
+        first = min(num_rec, self.capacity - idx)
+        self.records[idx:idx+first] = records[:first]
+        if first < num_rec:
+            self.records[:num_rec-first] = records[first:]
+
+        mark = self.marks[mark_head % self.max_batches]
+        mark['end'] = head + num_rec
+        mark['rcv_time'] = rcv_time
+
+        # Publish the records/mark before the counters the consumer reads
+        self.header[HEAD] = head + num_rec
+        self.header[MARK_HEAD] = mark_head + 1
+
+        if not self.ready.is_set():
+            self.ready.set()
+
+        return True
+
+    def put_nowait(self, item):
+        return self.put(item)
+
+    def get(self, block=True, timeout=None):
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        while self.empty():
+            if not block:
+                raise queue.Empty
+
+            self.ready.clear()
+            if not self.empty():
+                break
+
+            remaining = None if timeout is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise queue.Empty
+
+            self.ready.wait(remaining)
+
+        # Take every batch published so far in one read
+        mark_tail = int(self.header[MARK_TAIL])
+        mark_head = int(self.header[MARK_HEAD])
+        marks = self.marks[np.arange(mark_tail, mark_head) % self.max_batches]
+        end = int(marks['end'][-1])
+        tail = int(self.header[TAIL])
+        marks['end'] -= np.uint64(tail)  # offsets into the returned records
+
+        num_rec = end - tail
+        idx = tail % self.capacity
+        first = min(num_rec, self.capacity - idx)
+        if first == num_rec:
+            records = self.records[idx:idx+num_rec].copy()
+        else:
+            records = np.concatenate((self.records[idx:],
+                                      self.records[:num_rec-first]))
+
+        self.header[TAIL] = end
+        self.header[MARK_TAIL] = mark_head
+
+        return marks, records
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    async def get_async(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get, True, timeout)
+
+    def close(self):
+        del self.header, self.marks, self.records
+        self.shm.close()
+
+    def unlink(self):
+        if self.owner:
+            self.shm.unlink()
+
+
+class PhotonRingSet():
+    # One ring per ingest worker (each stays single-producer), read by the
+    # display as one channel. The rings share one `ready` event, so the
+    # consumer sleeps on all of them at once.
+    def __init__(self, num_rings, capacity, max_batches, dtype):
+        self.ready = Event()
+        self.rings = [PhotonRing(capacity, max_batches, dtype, ready=self.ready)
+                      for i in range(num_rings)]
+        self.next_ring = 0
+
+    @property
+    def overflow_batches(self):
+        return sum(ring.overflow_batches for ring in self.rings)
+
+    @property
+    def overflow_records(self):
+        return sum(ring.overflow_records for ring in self.rings)
+
+    def qsize(self):
+        return sum(ring.qsize() for ring in self.rings)
+
+    def empty(self):
+        return all(ring.empty() for ring in self.rings)
+
+    def get_ready(self):
+        # Round-robin, so a busy worker can't starve the others
+        for i in range(len(self.rings)):
+            idx = (self.next_ring + i) % len(self.rings)
+            if not self.rings[idx].empty():
+                self.next_ring = (idx + 1) % len(self.rings)
+                return self.rings[idx].get_nowait()
+        return None
+
+    def get(self, block=True, timeout=None):
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        while True:
+            item = self.get_ready()
+            if item is not None:
+                return item
+            if not block:
+                raise queue.Empty
+
+            self.ready.clear()
+            if not self.empty():
+                continue
+
+            remaining = None if timeout is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise queue.Empty
+
+            self.ready.wait(remaining)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    async def get_async(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get, True, timeout)
+
+    def close(self):
+        for ring in self.rings:
+            ring.close()
+
+    def unlink(self):
+        for ring in self.rings:
+            ring.unlink()
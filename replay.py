@@ -0,0 +1,107 @@
+# replay.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Replays a recorded .zph photon file into the sender -> receiver queue/ring,
+# in place of the UDP server, at 1x, Nx or unthrottled speed.
+###############################################################################
+
+import time
+import asyncio
+import numpy as np
+
+from udp_server import PHOTON_DTYPE
+from photon_file import PhotonFileReader
+from photon_ring import wait_for_room, MAX_PENDING
+
+class PhotonReplayer():
+    def __init__(self, logger, path, q_fifo, closing_event=None, speed=1.0,
+                 batch_time=2000, t_start=None, t_end=None, binner=None):
+        self.logger = logger
+        self.q_fifo = q_fifo
+        self.closing_event = closing_event
+        self.speed = speed  # 0 = as fast as the display keeps up
+        self.batch_time = batch_time / 1e6  # recorded time per injected batch
+        self.t_start = t_start
+        self.t_end = t_end
+        self.binner = binner  # pre-binning, as in the udp_server
+
+        self.reader = PhotonFileReader(path)
+        self.num_photons = 0
+        self.num_batches = 0
+
+        t_first, t_last = self.reader.time_range
+        self.logger.info(f'replaying {path}: {self.reader.num_records} photons, '
+                         f'{0 if t_first is None else t_last - t_first:.1f} s '
+                         f'at {"max" if speed == 0 else f"{speed}x"} speed')
+
+    def is_closing(self):
+        return self.closing_event is not None and self.closing_event.is_set()
+
+    async def start_replay(self):
+        t0_wall = time.time()
+        t0_rec = None
+
+        for records in self.reader.iter_chunks(self.t_start, self.t_end):
+            if len(records) == 0:
+                continue
+            if t0_rec is None:
+                t0_rec = records['rcv_time'][0]
+
+            # Split the chunk into batch_time windows of recorded time
+            rcv_times = records['rcv_time']
+            edges = np.arange(rcv_times[0], rcv_times[-1], self.batch_time)[1:]
+            bounds = np.concatenate(([0], np.searchsorted(rcv_times, edges), [len(records)]))
+
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                if hi == lo:
+                    continue
+                if self.is_closing():
+                    return self.finish(t0_wall)
+
+                if self.speed > 0:
+                    due = t0_wall + (rcv_times[lo] - t0_rec) / self.speed
+                    delay = due - time.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                await self.enqueue(records[lo:hi])
+
+        return self.finish(t0_wall)
+
+    async def enqueue(self, records):
+        photons = np.zeros(len(records), dtype=PHOTON_DTYPE)
+        photons['x'] = records['x']
+        photons['y'] = records['y']
+        photons['p'] = records['p']
+        photons['pad'] = records['src']
+        num_photons = len(photons)
+        if self.binner is not None:
+            photons = self.binner.bin(photons)
+
+        # A shm ring can't take more than its capacity in one batch
+        max_batch = getattr(self.q_fifo, 'capacity', max(len(photons), 1))
+        for lo in range(0, len(photons), max_batch):
+            batch = photons[lo:lo+max_batch]
+            # Unthrottled, also keep the queue short so the display keeps up
+            if not await wait_for_room(self.q_fifo, len(batch), self.is_closing,
+                                       max_pending=None if self.speed > 0 else MAX_PENDING):
+                return
+
+            # Stamped with the injection time so display latency stays meaningful
+            self.q_fifo.put((time.time(), batch))
+            self.num_batches += 1
+
+        self.num_photons += num_photons
+
+    def finish(self, t0_wall):
+        elapsed = max(time.time() - t0_wall, 1e-9)
+        self.logger.info(f'replay done: {self.num_photons} photons in {self.num_batches} batches, '
+                         f'{elapsed:.2f} s ({self.num_photons / elapsed:.0f} photons/s)')
+        self.reader.close()
+
+        return {
+            'photons': self.num_photons,
+            'batches': self.num_batches,
+            'elapsed_s': elapsed,
+        }
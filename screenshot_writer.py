@@ -0,0 +1,90 @@
+# screenshot_writer.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Background screenshot writer: the display hands over copies of the
+# accumulation plane and the 8-bit screen, a worker thread compresses them
+# to NPZ (raw data) and PNG (what was on screen).
+###############################################################################
+
+import os
+import time
+import zlib
+import queue
+import struct
+import threading
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COMPRESSION = 6
+MAX_PENDING = 8  # screenshots waiting to be written
+
+def png_chunk(tag, data):
+    return (struct.pack('>I', len(data)) + tag + data
+            + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+def write_png(path, img, level=PNG_COMPRESSION):
+    # 8-bit greyscale PNG, no filtering, from an (H, W) uint8 array
+    height, width = img.shape
+    raw = np.zeros((height, width + 1), dtype=np.uint8)  # filter byte per row
+    raw[:, 1:] = img
+
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        f.write(png_chunk(b'IDAT', zlib.compress(raw.tobytes(), level)))
+        f.write(png_chunk(b'IEND', b''))
+
+class ScreenshotWriter():
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger
+        self.last_name = None
+        self.name_count = 0
+
+        self.q = queue.Queue(maxsize=MAX_PENDING)
+        self.thread = threading.Thread(target=self.run, name='screenshot_writer', daemon=True)
+        self.thread.start()
+
+    def unique_name(self):
+        # Millisecond timestamp, with a suffix if two land in the same ms
+        now = time.time()
+        name = time.strftime('%Y%m%d_%H%M%S', time.localtime(now)) + f'_{int(now * 1000) % 1000:03d}'
+        if name == self.last_name:
+            self.name_count += 1
+            return f'{name}_{self.name_count}'
+
+        self.last_name = name
+        self.name_count = 0
+        return name
+
+    def submit(self, counts, screen, meta):
+        # counts / screen must be copies, the caller keeps drawing
+        name = self.unique_name()
+        try:
+            self.q.put_nowait((name, counts, screen, meta))
+        except queue.Full:
+            if self.logger is not None:
+                self.logger.warning(f'screenshot writer busy, dropped {name}')
+            return None
+
+        return name
+
+    def close(self):
+        self.q.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+
+            name, counts, screen, meta = item
+            filepath = os.path.join(self.path, name)
+            try:
+                np.savez_compressed(f'{filepath}.npz', counts=counts, **meta)
+                write_png(f'{filepath}.png', screen)
+            except OSError as exc:
+                if self.logger is not None:
+                    self.logger.error(f'screenshot {name} failed: {exc}')
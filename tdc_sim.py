@@ -0,0 +1,175 @@
+# tdc_sim.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Synthetic TDC packet generator: builds packets in the same layout the
+# udp_server expects (photon count, packet count, 2 alignment bytes, then
+# 6-byte X/Y/P photons) and sends them at a fixed photon rate.
+###############################################################################
+
+import sys
+import time
+import socket
+import argparse
+import shlex
+import numpy as np
+
+from udp_server import HEADER_LEN, PHOTON_DTYPE
+
+DETECTOR_SIZE = 2 ** 14  # 14-bit X/Y
+MAX_PHOTONS_PER_PACKET = (1472 - HEADER_LEN) // PHOTON_DTYPE.itemsize  # 1500B MTU
+DISTRIBUTIONS = ('uniform', 'gauss', 'spots')
+
+class TDCPacketGenerator():
+    def __init__(self, photons_per_packet=200, distribution='uniform',
+                 num_spots=4, spot_sigma=200, num_templates=256, seed=None):
+        self.photons_per_packet = photons_per_packet
+        self.distribution = distribution
+        self.num_spots = num_spots
+        self.spot_sigma = spot_sigma
+        self.rng = np.random.default_rng(seed)
+        self.pkt_count = 0
+
+        self.spots = self.rng.uniform(0.1, 0.9, (num_spots, 2)) * DETECTOR_SIZE
+
+        # Photon payloads are pre-generated so sending is not limited by numpy
+        self.templates = [self.make_packet(self.make_photons(photons_per_packet))
+                          for i in range(num_templates)]
+        self.template_idx = 0
+
+    def make_photons(self, num_photons):
+        photons = np.zeros(num_photons, dtype=PHOTON_DTYPE)
+
+        if self.distribution == 'gauss':
+            xy = self.rng.normal(DETECTOR_SIZE / 2, DETECTOR_SIZE / 8, (num_photons, 2))
+        elif self.distribution == 'spots':
+            centers = self.spots[self.rng.integers(0, self.num_spots, num_photons)]
+            xy = self.rng.normal(centers, self.spot_sigma)
+        else:
+            xy = self.rng.uniform(0, DETECTOR_SIZE, (num_photons, 2))
+
+        xy = np.clip(xy, 0, DETECTOR_SIZE - 1)
+        photons['x'] = xy[:, 0]
+        photons['y'] = xy[:, 1]
+        photons['p'] = np.clip(self.rng.normal(120, 40, num_photons), 1, 255)
+
+        return photons
+
+    def make_packet(self, photons, pkt_count=0):
+        header = np.array([len(photons), pkt_count, 0], dtype='<u2')
+        return bytearray(header.tobytes() + photons.tobytes())
+
+    def next_packet(self, pkt_count=None):
+        # Reuse a template, only the packet count changes. pkt_count given:
+        # the caller keeps the counter (one per simulated TDC)
+        packet = self.templates[self.template_idx]
+        self.template_idx = (self.template_idx + 1) % len(self.templates)
+
+        if pkt_count is None:
+            pkt_count = self.pkt_count
+            self.pkt_count = (self.pkt_count + 1) & 0xFFFF
+
+        packet[2] = pkt_count & 0xFF
+        packet[3] = (pkt_count >> 8) & 0xFF
+
+        return packet
+
+def open_sockets(src_ips):
+    socks = []
+    for src_ip in src_ips:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+        sock.bind((src_ip, 0))
+        socks.append(sock)
+    return socks
+
+def send_packets(gen, addr, rate, duration, src_ip='', sock=None):
+    # Send at `rate` photons/s (all sources together) for `duration` s,
+    # paced against the wall clock. src_ip may be a list of addresses (e.g.
+    # 127.0.0.x on loopback): packets rotate over one socket per address,
+    # each with its own packet counter like separate TDCs.
+    if sock is not None:
+        socks = [sock]
+    elif isinstance(src_ip, str):
+        socks = open_sockets([src_ip])
+    else:
+        socks = open_sockets(src_ip)
+    # Every source carries on from the generator's counter
+    pkt_counts = [gen.pkt_count] * len(socks)
+
+    pkt_rate = rate / gen.photons_per_packet
+    num_packets = 0
+    num_errors = 0
+
+    t_start = time.perf_counter()
+    t_end = t_start + duration
+    now = t_start
+    while now < t_end:
+        due = int((now - t_start) * pkt_rate) - num_packets
+        if due <= 0:
+            time.sleep(min(0.0005, 1 / pkt_rate))
+        for i in range(due):
+            src = num_packets % len(socks)
+            try:
+                socks[src].sendto(gen.next_packet(pkt_counts[src]), addr)
+            except OSError:
+                num_errors += 1
+            pkt_counts[src] = (pkt_counts[src] + 1) & 0xFFFF
+            num_packets += 1
+        now = time.perf_counter()
+
+    elapsed = time.perf_counter() - t_start
+    gen.pkt_count = pkt_counts[0]
+    if sock is None:
+        for s in socks:
+            s.close()
+
+    return {
+        'packets': num_packets - num_errors,
+        'photons': (num_packets - num_errors) * gen.photons_per_packet,
+        'send_errors': num_errors,
+        'elapsed_s': elapsed,
+    }
+
+def argparser(argv):
+    if argv is None:
+        argv = sys.argv[1:]
+    if isinstance(argv, str):
+        argv = shlex.split(argv)
+
+    parser = argparse.ArgumentParser(sys.argv[0])
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='destination address')
+    parser.add_argument('--port', type=int, default=60000,
+                        help='destination port')
+    parser.add_argument('--srcIP', type=str, default='',
+                        help='source address to send from, or a comma-separated list \
+                            to interleave several simulated TDCs')
+    parser.add_argument('--rate', type=float, default=1e5,
+                        help='photons per second')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to send for')
+    parser.add_argument('--photonsPerPacket', type=int, default=200,
+                        help=f'photons per packet (max {MAX_PHOTONS_PER_PACKET})')
+    parser.add_argument('--dist', type=str, default='uniform', choices=DISTRIBUTIONS,
+                        help='photon X/Y distribution')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed')
+    opts = parser.parse_args(argv)
+
+    return opts
+
+def main(argv=None):
+    opts = argparser(argv)
+
+    gen = TDCPacketGenerator(photons_per_packet=opts.photonsPerPacket,
+                             distribution=opts.dist,
+                             seed=opts.seed)
+    result = send_packets(gen, (opts.host, opts.port), opts.rate, opts.duration,
+                          opts.srcIP.split(','))
+
+    print(f'sent {result["packets"]} packets / {result["photons"]} photons '
+          f'in {result["elapsed_s"]:.2f} s')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# kernel_filter_test.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Loopback check of the BPF source filter: two known and one unknown
+# simulated TDC (127.0.0.x) plus runt datagrams. With the filter only the
+# known sources' photons reach the parser; without it the Python checks
+# have to catch the rest. Run from the repo root: python tests/kernel_filter_test.py
+###############################################################################
+
+import os
+import sys
+import queue
+import socket
+import asyncio
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from udp_server import AsyncUDPServer
+from tdc_sim import TDCPacketGenerator, send_packets
+
+LOCAL_IP = '127.0.0.1'
+PORT = 60123
+KNOWN_IPS = ['127.0.0.2', '127.0.0.3']
+UNKNOWN_IP = '127.0.0.4'
+RATE = 200000
+DURATION = 0.5
+PHOTONS_PER_PACKET = 100
+NUM_RUNTS = 5
+
+async def run_check(kernel_filter):
+    logger = logging.getLogger('kernel_filter_test')
+    tdc_dict = {f'tdc_{i}': ip for i, ip in enumerate(KNOWN_IPS)}
+    ip_dict = {ip: name for name, ip in tdc_dict.items()}
+
+    udp_server = AsyncUDPServer(logger, LOCAL_IP, PORT, queue.Queue(),
+                                tdc_dict=tdc_dict, ip_dict=ip_dict, stats_interval=0,
+                                rcv_buf=8 * 1024 * 1024, kernel_filter=kernel_filter)
+    transport, protocol = await udp_server.start_server()
+
+    # Blocking sender in a thread, the loop keeps receiving
+    loop = asyncio.get_running_loop()
+    gen = TDCPacketGenerator(photons_per_packet=PHOTONS_PER_PACKET, seed=0)
+    sent = await loop.run_in_executor(None, send_packets, gen, (LOCAL_IP, PORT), RATE,
+                                      DURATION, KNOWN_IPS + [UNKNOWN_IP])
+
+    runt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    runt.bind((KNOWN_IPS[0], 0))
+    for i in range(NUM_RUNTS):
+        runt.sendto(b'\x01\x00', (LOCAL_IP, PORT))
+    runt.close()
+
+    await asyncio.sleep(0.5)
+    protocol.log_stats()  # reads the socket's drop counter
+    snap = protocol.stats.snapshot()
+    udp_server.close()
+
+    # Packets rotate over the sources, the unknown one is every third
+    unknown_packets = sent['packets'] // 3
+    known_photons = (sent['packets'] - unknown_packets) * PHOTONS_PER_PACKET
+    assert snap['kernel_drops'] in (0, None), snap
+    assert snap['photons'] == known_photons, (snap['photons'], known_photons)
+    if kernel_filter:
+        assert snap['unknown_src'] == 0 and snap['truncated'] == 0, snap
+        assert snap['filtered'] == unknown_packets + NUM_RUNTS, (snap['filtered'], unknown_packets)
+    else:
+        assert snap['unknown_src'] == unknown_packets, (snap['unknown_src'], unknown_packets)
+        assert snap['truncated'] == NUM_RUNTS, snap
+
+    print(f'kernel_filter={kernel_filter}: OK ({sent["packets"]} packets sent, '
+          f'{snap["photons"]} photons accepted, unknown_src={snap["unknown_src"]}, '
+          f'truncated={snap["truncated"]}, filtered={snap["filtered"]})')
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run_check(kernel_filter=True))
+    asyncio.run(run_check(kernel_filter=False))
+
+if __name__ == "__main__":
+    main()
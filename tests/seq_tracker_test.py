@@ -0,0 +1,62 @@
+# seq_tracker_test.py
+# Aidan Gray
+# aidan.gray@idg.jhu.edu
+#
+# Checks the per-source packet counter accounting: wraparound, reordering,
+# duplicates and TDC restarts (from a low and from a high count).
+# Run from the repo root: python tests/seq_tracker_test.py
+###############################################################################
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest_stats import SequenceTracker, PKT_COUNT_MOD, RESTART_RUN
+
+def feed(counts, tracker=None):
+    tracker = SequenceTracker() if tracker is None else tracker
+    kept = [count for count in counts if tracker.update(count % PKT_COUNT_MOD)]
+    return tracker, kept
+
+def check(name, tracker, kept, num_kept, **expected):
+    got = {key: getattr(tracker, key) for key in expected}
+    assert len(kept) == num_kept, (name, len(kept), num_kept)
+    assert got == expected, (name, got, expected)
+    print(f'{name}: OK ({num_kept} kept, {got})')
+
+def main():
+    # 65535 -> 0 is the next packet, not a restart
+    tracker, kept = feed(range(65000, 66000))
+    check('wrap', tracker, kept, 1000, lost=0, reordered=0, duplicates=0, resets=0)
+
+    # Swapped pairs and a packet 100 late
+    counts = list(range(1000))
+    for i in range(10, 900, 50):
+        counts[i], counts[i+1] = counts[i+1], counts[i]
+    counts.remove(500)
+    counts.insert(600, 500)
+    tracker, kept = feed(counts)
+    check('reorder', tracker, kept, 1000, lost=0, reordered=19, duplicates=0, resets=0)
+
+    # Lost packets, then repeats
+    counts = [c for c in range(1000) if c % 100 != 7] + [990, 995, 999]
+    tracker, kept = feed(counts)
+    check('loss + duplicates', tracker, kept, 990, lost=10, duplicates=3, resets=0)
+
+    # Restart while the counter is still inside the window: only the
+    # run that reveals it is lost
+    tracker, kept = feed(list(range(500)) + list(range(500)))
+    check('restart from 500', tracker, kept, 1000 - (RESTART_RUN - 1),
+          lost=RESTART_RUN - 1, duplicates=0, resets=1)
+
+    # Restart from past half the counter range
+    tracker, kept = feed(list(range(40000)) + list(range(500)))
+    check('restart from 40000', tracker, kept, 40500, lost=0, duplicates=0, resets=1)
+
+    # Restart from below half the counter range
+    tracker, kept = feed(list(range(20000)) + list(range(500)))
+    check('restart from 20000', tracker, kept, 20500, lost=0, duplicates=0, resets=1)
+
+if __name__ == "__main__":
+    main()
@@ -14,98 +14,234 @@ import time
 import sys
 import argparse
 import shlex
+import numpy as np
 from multiprocessing import Process, Queue, Event
 from signal import SIGINT, SIGTERM
 
+from ingest_stats import IngestStats, read_kernel_drops
+from batched_ingest import BatchedUDPReader
+from photon_file import PhotonRecorder
+from pcap_reader import PcapReader
+from bpf_filter import build_source_filter, attach_filter, build_shard_filter, attach_shard_filter
+
+# TDC packet layout: a 6-byte header (photon count, packet count, 2 alignment
+# bytes) followed by 6-byte photons (X, Y, P, pad), all little-endian.
+# Downstream of the server the pad byte carries the photon's source index.
+HEADER_LEN = 6
+PHOTON_DTYPE = np.dtype([('x', '<u2'), ('y', '<u2'), ('p', 'u1'), ('pad', 'u1')])
+
+class AsyncUDPServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, logger, loop, q_fifo,
+                 closing_event=None, tdc_dict=None, ip_dict=None, stats_interval=10,
+                 batch_packets=1, batch_time=2000, recorder=None, binner=None):
+        self.logger = logger
+        self.loop = loop
+        self.q_fifo = q_fifo
+        self.closing_event = closing_event
+        self.tdc_dict = tdc_dict
+        self.ip_dict = ip_dict
+        self.stats_interval = stats_interval
+
+        self.stats = IngestStats()
+
+        # Coalesce up to batch_packets packets, held for at most batch_time us,
+        # into one downstream (rcv_time, photons) message
+        self.batch_packets = batch_packets
+        self.batch_time = batch_time / 1e6
+        self.batch = []
+        self.batch_src = []
+        self.batch_rcv_time = None
+        self.batch_timer = None
+
+        # Optional raw photon recording, sources stored by index into tdc_dict
+        self.recorder = recorder
+        self.src_index = {src: i for i, src in enumerate(tdc_dict or {})}
+
+        # Optional pre-binning: ship sparse screen-pixel deltas, not photons
+        self.binner = binner
+        
+        super().__init__()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.logger.info('... udp server started')
+        if self.stats_interval:
+            self.loop.call_later(self.stats_interval, self.log_stats)
+
+    def log_stats(self):
+        sock = self.transport.get_extra_info('socket')
+        if sock is not None:
+            socket_drops = read_kernel_drops(sock)
+            if socket_drops is not None:
+                self.stats.socket_drops = socket_drops
+
+        self.logger.info(f'ingest: {self.stats.format_snapshot(self.stats.snapshot())}')
+        if not self.transport.is_closing():
+            self.loop.call_later(self.stats_interval, self.log_stats)
+        
+    def datagram_received(self, data, addr):
+        rcv_time = time.time()    
+        # Normally the kernel filter has already dropped other sources
+        if addr[0] in self.ip_dict:
+            self.logger.debug(f'DATA=\'{data}\'')
+            self.logger.debug(f'SRC=\'{addr}\'' ) 
+            self.logger.debug(f'TIME=\'{rcv_time}\'')
+            datagram = (rcv_time, addr, data)
+            self.parse_datagram(datagram)
+        else:
+            self.stats.unknown_src += 1
+
+    def error_received(self, exc):
+        self.logger.error(f'Error received: \'{exc}\'')
+
+    def connection_lost(self, exc):
+        self.flush_batch()
+        self.logger.warn(f'Connection lost: \'{exc}\'')
+
+    def parse_datagram(self, dgram, copy=False):
+        # copy: the data is a reused receive buffer (batched ingest's pool),
+        # so the photons that are kept must be copied out of it
+        pkt_timestamp = dgram[0]
+        pkt_src_addr = dgram[1]
+        pkt_data = dgram[2]
+
+        pkt_src = self.ip_dict[pkt_src_addr[0]]
+        self.stats.packets += 1
+        self.stats.bytes += len(pkt_data)
+
+        if len(pkt_data) < HEADER_LEN:
+            self.stats.truncated += 1
+            return
+
+        pkt_count = (pkt_data[3]<<8) + pkt_data[2]
+
+        self.logger.debug(f'PACKET_TIMESTAMP: {pkt_timestamp}')
+        self.logger.debug(f'PACKET_SOURCE: {pkt_src}')
+        self.logger.debug(f'PACKET_COUNT: {pkt_count}')
+        
+        # Make sure the data is aligned properly
+        if pkt_data[4] != 0 or pkt_data[5] != 0:
+            self.stats.misaligned += 1
+            return
+
+        num_photons = (pkt_data[1]<<8) + pkt_data[0]
+        num_photon_bytes = num_photons * PHOTON_DTYPE.itemsize
+        self.logger.debug(f'NUM_PHOTONS: {num_photons} ({num_photon_bytes}B)')
+
+        if len(pkt_data) < HEADER_LEN + num_photon_bytes:
+            self.stats.truncated += 1
+            self.logger.debug(f'TRUNCATED PACKET: {len(pkt_data)}B < {HEADER_LEN + num_photon_bytes}B')
+            return
+
+        # Gap/reorder accounting per source, drops repeated packets
+        if not self.stats.track(pkt_src, pkt_count):
+            self.logger.debug(f'DUPLICATE PACKET: {pkt_count}')
+            return
+
+        if num_photons > 0:
+            # View the photons (X, Y, P, pad) as one structured array,
+            # no per-photon slicing or decoding in Python
+            photons = np.frombuffer(pkt_data, 
+                                    dtype=PHOTON_DTYPE, 
+                                    count=num_photons, 
+                                    offset=HEADER_LEN)
+            if copy:
+                photons = photons.copy()
+            self.stats.photons += num_photons
+            if self.recorder is not None:
+                self.recorder.record(pkt_timestamp, self.src_index[pkt_src], pkt_count, photons)
+            self.batch_photons(pkt_timestamp, photons, self.src_index[pkt_src])
+
+        else:
+            self.logger.debug(f'NO PHOTONS')
+
+    def batch_photons(self, rcv_time, photons, src=0):
+        if len(self.batch) == 0:
+            self.batch_rcv_time = rcv_time
+            if self.batch_packets > 1:
+                # Don't hold a partial batch if the packets stop coming
+                self.batch_timer = self.loop.call_later(self.batch_time, self.flush_batch)
+
+        self.batch.append(photons)
+        self.batch_src.append(src)
+
+        if len(self.batch) >= self.batch_packets \
+                or (rcv_time - self.batch_rcv_time) >= self.batch_time:
+            self.flush_batch()
+
+    def flush_batch(self):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+
+        if len(self.batch) == 0:
+            return
+        elif len(self.batch) == 1:
+            photons = self.batch[0]
+        else:
+            photons = np.concatenate(self.batch)
+
+        # Source index (into tdc_dict) in the pad byte, so the display (or
+        # a split-screen binner) can tell sources apart however batches merge
+        if not photons.flags.writeable:
+            photons = photons.copy()
+        photons['pad'] = np.repeat(np.array(self.batch_src, dtype=np.uint8),
+                                   [len(b) for b in self.batch])
+
+        if self.binner is not None:
+            photons = self.binner.bin(photons)
+
+        self.enqueue_fifo((self.batch_rcv_time, photons))
+        self.batch = []
+        self.batch_src = []
+
+    def enqueue_fifo(self, data):
+        if self.q_fifo.full():
+            self.stats.queue_drops += 1
+            self.logger.warning(f'FIFO Queue is full')
+        elif self.q_fifo.put(data) is False:
+            # shm ring had no room for the whole batch
+            self.stats.queue_drops += 1
 
 class AsyncUDPServer:
     def __init__(self, logger, local_ip, port,  q_fifo, 
-                 closing_event=None, tdc_dict=None, ip_dict=None):
+                 closing_event=None, tdc_dict=None, ip_dict=None, stats_interval=10,
+                 ingest='protocol', rcv_buf=0, recv_batch=64, busy_poll=0,
+                 batch_packets=1, batch_time=2000, record_path=None, pcap_path=None,
+                 binner=None, kernel_filter=True, workers=1):
         self.logger = logger
         self.addr = (local_ip, port)
         self.q_fifo = q_fifo
         self.closing_event = closing_event
         self.tdc_dict = tdc_dict
         self.ip_dict = ip_dict
+        self.stats_interval = stats_interval
+
+        # ingest: 'protocol' = asyncio DatagramProtocol, one callback per datagram
+        #         'batched'  = drain every ready datagram per wake-up (recvmmsg)
+        self.ingest = ingest
+        self.rcv_buf = rcv_buf
+        self.recv_batch = recv_batch
+        self.busy_poll = busy_poll
+        self.batch_packets = batch_packets
+        self.batch_time = batch_time
+        self.record_path = record_path
+        self.pcap_path = pcap_path  # read datagrams from a capture instead of a socket
+        self.binner = binner
+        self.kernel_filter = kernel_filter  # drop unknown sources with a BPF socket filter
+        self.workers = workers  # ingest processes sharing the port via SO_REUSEPORT
         
         self.server_task = None
+        self.transport = None
+        self.recorder = None
 
         self.logger.info(f'starting udp_server ...')
             
     async def start_server(self):
-        class AsyncUDPServerProtocol(asyncio.DatagramProtocol):
-            def __init__(self, logger, loop, q_fifo,
-                         closing_event=None, tdc_dict=None, ip_dict=None):
-                self.logger = logger
-                self.loop = loop
-                self.q_fifo = q_fifo
-                self.closing_event = closing_event
-                self.tdc_dict = tdc_dict
-                self.ip_dict = ip_dict
-
-                self.packet_count = 0
-                
-                super().__init__()
-
-            def connection_made(self, transport):
-                self.transport = transport
-                self.logger.info('... udp server started')
-                
-            def datagram_received(self, data, addr):
-                rcv_time = time.time()    
-                if addr[0] in self.tdc_dict.values():
-                    self.logger.debug(f'DATA=\'{data}\'')
-                    self.logger.debug(f'SRC=\'{addr}\'' ) 
-                    self.logger.debug(f'TIME=\'{rcv_time}\'')
-                    datagram = (rcv_time, addr, data)
-                    asyncio.ensure_future(self.datagram_handler(datagram))
-
-            def error_received(self, exc):
-                self.logger.error(f'Error received: \'{exc}\'')
-
-            def connection_lost(self, exc):
-                self.logger.warn(f'Connection lost: \'{exc}\'')
-
-            async def datagram_handler(self, dgram): 
-                pkt_timestamp = dgram[0]
-                pkt_src_addr = dgram[1]
-                pkt_data = dgram[2]
-    
-                pkt_src = self.ip_dict[pkt_src_addr[0]]
-                pkt_count = (pkt_data[3]<<8) + pkt_data[2]
-    
-                self.logger.debug(f'PACKET_TIMESTAMP: {pkt_timestamp}')
-                self.logger.debug(f'PACKET_SOURCE: {pkt_src}')
-                self.logger.debug(f'PACKET_COUNT: {pkt_count}')
-                
-                # Make sure the data is aligned properly and is newest packet            
-                if (pkt_data[4] == 0) and pkt_data[5] == 0 and (pkt_count >= self.packet_count):
-                    num_photons = (pkt_data[1]<<8) + pkt_data[0]
-                    num_photon_bytes = num_photons * 6
-                    self.logger.debug(f'NUM_PHOTONS: {num_photons} ({num_photon_bytes}B)')
-    
-                    if num_photons > 0:
-                        # Split the packet into photons (X, Y, P) each consisting of 2 bytes
-                        data_photons = pkt_data[6:]
-                        photon_list = [data_photons[i:i+6] for i in range(0, num_photon_bytes, 6)]
-                        self.enqueue_fifo(photon_list)         
-    
-                    else:
-                        self.logger.debug(f'NO PHOTONS')
-                        await asyncio.sleep(0)
-                    
-                    self.packet_count = pkt_count
-
-            def enqueue_fifo(self, data):
-                if self.q_fifo.full():
-                    self.logger.warning(f'FIFO Queue is full')
-                else:
-                    self.q_fifo.put(data)
-
         loop = asyncio.get_event_loop()
-        
-        s=socket(AF_INET, SOCK_DGRAM)
-        s.bind(self.addr)
+
+        if self.record_path is not None:
+            self.recorder = PhotonRecorder(self.record_path, self.tdc_dict, self.logger)
 
         protocol = AsyncUDPServerProtocol(
             self.logger,
@@ -114,10 +250,74 @@ class AsyncUDPServer:
             self.closing_event,
             self.tdc_dict,
             self.ip_dict,
+            self.stats_interval,
+            self.batch_packets,
+            self.batch_time,
+            self.recorder,
+            self.binner,
             )
+
+        if self.pcap_path is not None:
+            reader = PcapReader(self.logger, loop, self.pcap_path, protocol, self.addr[1])
+            reader.start()
+            self.transport = reader
+            return reader, protocol
+
+        s=socket(AF_INET, SOCK_DGRAM)
+        if self.rcv_buf:
+            s.setsockopt(SOL_SOCKET, SO_RCVBUF, self.rcv_buf)
+            # Linux doubles the request and caps it at net.core.rmem_max
+            self.logger.info(f'SO_RCVBUF = {s.getsockopt(SOL_SOCKET, SO_RCVBUF)}B '
+                             f'(requested {self.rcv_buf}B)')
+        if self.kernel_filter:
+            self.attach_source_filter(s, protocol)
+        if self.workers > 1:
+            s.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        s.bind(self.addr)
+        if self.workers > 1:
+            self.attach_shard_filter(s)
+
+        if self.ingest == 'batched':
+            reader = BatchedUDPReader(self.logger,
+                                      loop,
+                                      s,
+                                      protocol,
+                                      self.recv_batch,
+                                      self.busy_poll)
+            reader.start()
+            self.transport = reader
+            return reader, protocol
         
-        return await loop.create_datagram_endpoint(
+        self.transport, protocol = await loop.create_datagram_endpoint(
             lambda: protocol, sock=s)
+        return self.transport, protocol
+
+    def attach_source_filter(self, s, protocol):
+        # Before bind, so nothing unfiltered is queued; the protocol's own
+        # source check stays as the fallback
+        try:
+            attach_filter(s, build_source_filter(self.ip_dict, HEADER_LEN))
+            # Rejected datagrams count as socket drops: report them apart
+            # from receive buffer overflows
+            protocol.stats.use_rcvbuf_errors()
+            self.logger.info(f'kernel source filter attached ({len(self.ip_dict)} sources)')
+        except (OSError, ValueError) as exc:
+            self.logger.warning(f'kernel source filter not attached, filtering in Python: {exc}')
+
+    def attach_shard_filter(self, s):
+        # Without it the kernel hashes on (src ip, src port), which keeps a
+        # source on one worker but may put two sources on the same one
+        try:
+            attach_shard_filter(s, build_shard_filter(self.ip_dict, self.workers))
+        except (OSError, ValueError) as exc:
+            self.logger.warning(f'SO_REUSEPORT shard filter not attached, kernel hashes sources: {exc}')
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
 async def runUDPserverTest(logger, local_ip, port, q_fifo, closing_event, tdc_dict, ip_dict):
     udp_server = AsyncUDPServer(logger, local_ip, port, q_fifo, closing_event, tdc_dict, ip_dict)